@@ -0,0 +1,422 @@
+"""
+asyncio IMAP fetch engine
+
+An alternative to the imaplib fetch path, used with `engine: asyncio`. All the
+connections of an account are driven from one event loop, several tagged
+commands are in flight on every connection, and fetched batches are handed to
+writer threads so the loop keeps reading while messages hit the disk.
+"""
+import asyncio
+import imaplib
+import re
+import ssl
+import time
+from collections import OrderedDict, deque
+
+from .filters import account_filters, compile_filters
+from .mailutils import (
+    HEADER_QUERY,
+    FetchStats,
+    MessageSelector,
+    account_id,
+    finish_folder,
+    open_index,
+    open_writer,
+    parse_fetch_response,
+    save_batch,
+    search_query,
+    server_slots,
+    uid_set,
+)
+from .utils import normalize
+
+
+untagged_re = re.compile(rb"^\* (?:(\d+) )?([A-Za-z-]+)(?: (.*))?$", re.S)
+tagged_re = re.compile(rb"^(\S+) ([A-Za-z]+)(?: (.*))?$", re.S)
+literal_re = re.compile(rb"\{(\d+)\}$")
+code_re = re.compile(rb"^\[([A-Za-z-]+)(?: ([^\]]*))?\]")
+
+MESSAGE_QUERY = "(FLAGS RFC822)"
+
+# SEARCH responses of big folders do not fit the default 64 KB line limit
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def quote(value):
+    """
+    Returns an IMAP quoted string
+    """
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class AsyncIMAP:
+    """
+    Minimal asyncio IMAP client
+
+    command() writes a tagged command right away, without waiting for the
+    previous ones to complete, and returns a future of (typ, untagged, text).
+    untagged is {TYPE: [data]} laid out like imaplib's untagged_responses, so
+    the imaplib response parsers of mailutils apply. Untagged responses go to
+    the oldest pending command, IMAP servers answer pipelined commands in order.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.counter = 0
+        self.pending = OrderedDict()
+        self.untagged = {}
+        self.capabilities = ()
+        self.error = None
+        self.greeting = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self.read_responses())
+
+    @classmethod
+    async def connect(cls, host, port = None, use_ssl = True):
+        context = ssl.create_default_context() if use_ssl is True else None
+        port = port or (imaplib.IMAP4_SSL_PORT if use_ssl is True else imaplib.IMAP4_PORT)
+        reader, writer = await asyncio.open_connection(host, port, ssl=context, limit=LINE_LIMIT)
+        connection = cls(reader, writer)
+        await connection.greeting
+        if use_ssl == 'starttls':
+            await connection.check('STARTTLS')
+            await writer.start_tls(ssl.create_default_context(), server_hostname=host)
+
+        return connection
+
+    async def read_response(self):
+        """
+        Reads one response with its literals, returns [line] or
+        [(line, literal), ..., rest of the line]
+        """
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by the server")
+
+        parts = []
+        line = line.rstrip(b"\r\n")
+        found = literal_re.search(line)
+        while found:
+            literal = await self.reader.readexactly(int(found.group(1)))
+            parts.append((line, literal))
+            line = (await self.reader.readline()).rstrip(b"\r\n")
+            found = literal_re.search(line)
+        parts.append(line)
+
+        return parts
+
+    async def read_responses(self):
+        try:
+            while True:
+                parts = await self.read_response()
+                first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if first.startswith(b"* "):
+                    self.untagged_response(parts)
+                    continue
+
+                tagged = tagged_re.match(first)
+                tag = tagged.group(1).decode() if tagged else None
+                if tag in self.pending:
+                    future, untagged = self.pending.pop(tag)
+                    if not future.done():
+                        future.set_result((tagged.group(2).decode().upper(), untagged, tagged.group(3) or b""))
+        except Exception as e:
+            self.close_pending(e if isinstance(e, OSError) else ConnectionError("connection lost: %r" % e))
+
+    def close_pending(self, error):
+        self.error = error
+        for future, untagged in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+                # Pipelined commands given up on are not awaited, keep quiet about them
+                future.exception()
+        self.pending.clear()
+        if not self.greeting.done():
+            self.greeting.set_exception(error)
+
+    def untagged_response(self, parts):
+        first = parts[0]
+        found = untagged_re.match(first[0] if isinstance(first, tuple) else first)
+        if not found:
+            return
+
+        number, typ, data = found.groups()
+        typ = typ.decode().upper()
+        data = data or b""
+        if number:
+            data = number + b" " + data
+        items = [(data, first[1]) if isinstance(first, tuple) else data] + parts[1:]
+
+        if not self.greeting.done():
+            if typ == 'BYE':
+                self.greeting.set_exception(ConnectionError(data.decode(errors="replace")))
+            else:
+                self.greeting.set_result(data)
+
+        untagged = self.pending[next(iter(self.pending))][1] if self.pending else self.untagged
+        # Response codes, e.g. * OK [UIDVALIDITY 1000], are filed like imaplib does
+        code = code_re.match(data) if typ in ('OK', 'NO', 'BAD', 'PREAUTH') else None
+        if code:
+            untagged.setdefault(code.group(1).decode().upper(), []).append(code.group(2))
+            if code.group(1).upper() == b'CAPABILITY':
+                self.capabilities = tuple((code.group(2) or b"").decode().upper().split())
+        if typ == 'CAPABILITY':
+            self.capabilities = tuple(data.decode().upper().split())
+
+        for item in items:
+            untagged.setdefault(typ, []).append(item)
+
+    def command(self, name, *args):
+        """
+        Sends a command and returns the future of its completion
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.error:
+            future.set_exception(self.error)
+            future.exception()
+            return future
+
+        self.counter += 1
+        tag = "A%04d" % self.counter
+        self.pending[tag] = (future, {})
+        self.writer.write(("%s %s\r\n" % (tag, " ".join((name,) + args))).encode())
+
+        return future
+
+    async def drain(self):
+        if self.error:
+            raise self.error
+        await self.writer.drain()
+
+    async def check(self, name, *args):
+        """
+        Runs a command, raises imaplib.IMAP4.error unless it completes with OK
+        """
+        future = self.command(name, *args)
+        await self.drain()
+        typ, untagged, text = await future
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("%s failed: %s" % (name, text.decode(errors="replace")))
+
+        return untagged
+
+    async def pipelined(self, commands, depth):
+        """
+        Runs commands keeping up to depth of them in flight, yields the
+        untagged responses of each one, in order
+        """
+        commands = iter(commands)
+        in_flight = deque()
+        while True:
+            for command in commands:
+                in_flight.append((command[0], self.command(*command)))
+                if len(in_flight) >= depth:
+                    break
+            if not in_flight:
+                return
+
+            await self.drain()
+            name, future = in_flight.popleft()
+            typ, untagged, text = await future
+            if typ != 'OK':
+                raise imaplib.IMAP4.error("%s failed: %s" % (name, text.decode(errors="replace")))
+            yield untagged
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.check('LOGOUT'), 5)
+        except Exception:
+            pass
+        self.task.cancel()
+        self.writer.close()
+
+
+async def connect_account(settings):
+    """
+    Opens a new authenticated asyncio connection for an account
+    """
+    connection = await AsyncIMAP.connect(settings.get('domain'), settings.get('port'), settings.get('ssl', True))
+    try:
+        await connection.check('LOGIN', quote(settings.get('username')), quote(settings.get('password')))
+        await connection.check('CAPABILITY')
+        if 'ENABLE' in connection.capabilities and 'UTF8=ACCEPT' in connection.capabilities:
+            await connection.check('ENABLE', 'UTF8=ACCEPT')
+    except Exception:
+        await connection.logout()
+        raise
+
+    return connection
+
+
+async def plan_folder(connection, mail_folder, settings, db, status, depth):
+    """
+    Same as mailutils.plan_folder, with the header batches pipelined
+    """
+    try:
+        untagged = await connection.check('EXAMINE', quote(mail_folder))
+    except imaplib.IMAP4.error as imaperror:
+        print("Unable to select folder %s: %s" % (normalize(mail_folder, "utf7"), imaperror))
+        return None
+
+    uidvalidity = int(untagged['UIDVALIDITY'][0]) if untagged.get('UIDVALIDITY') else None
+    last_uid = 0
+    checkpoint = db.get_checkpoint(account_id(settings), mail_folder)
+    if checkpoint and uidvalidity and checkpoint['uidvalidity'] == uidvalidity:
+        last_uid = checkpoint['last_uid']
+    elif checkpoint:
+        print("UIDVALIDITY of folder %s changed, doing a full resync" % normalize(mail_folder, "utf7"))
+        # Former UIDs now name other messages
+        db.forget_uids(account_id(settings), mail_folder)
+
+    filters = account_filters(settings)
+    criteria, rules = compile_filters(filters)
+    try:
+        untagged = await connection.check('UID', 'SEARCH', search_query(last_uid, criteria))
+    except imaplib.IMAP4.error as e:
+        if not criteria:
+            raise
+        print("Server refused the filters of folder %s (%s), evaluating them on headers" % (normalize(mail_folder, "utf7"), e))
+        rules = filters
+        untagged = await connection.check('UID', 'SEARCH', search_query(last_uid, []))
+    # "n:*" always matches the highest UID, even when it is lower than n
+    uids = [int(uid) for data in untagged.get('SEARCH', []) for uid in data.decode().split() if int(uid) > last_uid]
+
+    batch_size = int(settings.get('header_batch_size', 1000))
+    selector = MessageSelector(mail_folder, settings, db, rules)
+    batches = [uids[pos:pos + batch_size] for pos in range(0, len(uids), batch_size)]
+    async for untagged in connection.pipelined([('UID', 'FETCH', uid_set(batch), HEADER_QUERY) for batch in batches], depth):
+        for uid, header_bytes, envelope in parse_fetch_response(untagged.get('FETCH', [])):
+            selector.add(uid, header_bytes, envelope)
+    to_download = selector.done()
+    print("Checked headers of folder %s (%d), %d to download" % (normalize(mail_folder, "utf7"), len(uids), len(to_download)))
+
+    return {
+        "folder": mail_folder,
+        "uidvalidity": uidvalidity,
+        "last_uid": max(uids + [last_uid]),
+        "to_download": to_download,
+        "status": status,
+        "highestmodseq": None,
+        "synced_modseq": None,
+    }
+
+
+async def download_folder(connection, plan, settings, db, stats, depth):
+    """
+    Downloads the messages of a plan, depth UID FETCH commands in flight
+
+    Every batch is written, made durable and indexed in a writer thread, then
+    the checkpoint moves past it as long as nothing failed.
+
+    Returns (downloaded, failed)
+    """
+    loop = asyncio.get_running_loop()
+    mail_folder = plan["folder"]
+    to_download = plan["to_download"]
+    batch_size = int(settings.get('fetch_batch_size', 200))
+    uids = sorted(to_download)
+    batches = [uids[pos:pos + batch_size] for pos in range(0, len(uids), batch_size)]
+    writer = open_writer(settings, mail_folder)
+
+    downloaded = 0
+    failed = 0
+    fetched = connection.pipelined([('UID', 'FETCH', uid_set(batch), MESSAGE_QUERY) for batch in batches], depth)
+    pos = 0
+    async for untagged in fetched:
+        batch = batches[pos]
+        pos += 1
+        received = list(parse_fetch_response(untagged.get('FETCH', [])))
+        saved, batch_failed = await loop.run_in_executor(None, save_batch, mail_folder, settings, db, writer, to_download, batch, received, stats)
+        downloaded += saved
+        failed += batch_failed
+        if not failed:
+            finish_folder(db, settings, plan, batch[-1])
+
+    if not failed:
+        finish_folder(db, settings, plan)
+
+    return downloaded, failed
+
+
+async def download_folders_async(settings, changed, stats):
+    """
+    Archives the folders of an account over a pool of asyncio connections,
+    each connection working through whole folders
+    """
+    size = max(1, int(settings.get('connections', 1)))
+    size = min(size, int(settings.get('max_connections_per_server', 4)))
+    depth = max(1, int(settings.get('pipeline_depth', 4)))
+    max_retries = int(settings.get('max_retries', 5))
+    backoff = float(settings.get('retry_backoff', 1))
+    db = open_index(settings)
+
+    # The first connection runs on the slot held by the caller, once it has
+    # logged out of its own connection
+    slots = server_slots(settings)
+    extra = 0
+    while extra < size - 1 and slots.acquire(blocking=False):
+        extra += 1
+
+    folders = asyncio.Queue()
+    for folder_id, status in changed.items():
+        folders.put_nowait((folder_id, status))
+
+    totals = {'downloaded': 0}
+
+    async def worker():
+        connection = None
+        while not folders.empty():
+            folder_id, status = folders.get_nowait()
+            attempt = 0
+            while True:
+                try:
+                    if connection is None:
+                        connection = await connect_account(settings)
+                    plan = await plan_folder(connection, folder_id, settings, db, status, depth)
+                    if plan:
+                        downloaded, failed = await download_folder(connection, plan, settings, db, stats, depth)
+                        totals['downloaded'] += downloaded
+                        print("Done with folder: %s (%d messages)." % (normalize(folder_id, "utf7"), downloaded))
+                    break
+                except (OSError, EOFError) as e:
+                    if connection is not None:
+                        await connection.logout()
+                        connection = None
+                    attempt += 1
+                    if attempt > max_retries:
+                        stats.fail(folder_id, None, "connection lost: %s" % e)
+                        break
+                    delay = backoff * 2 ** (attempt - 1)
+                    print("Connection lost (%s), reconnecting in %.1fs (#%d)" % (e, delay, attempt))
+                    stats.retry(0)
+                    await asyncio.sleep(delay)
+                except imaplib.IMAP4.error as e:
+                    print("Giving up on folder %s: %s" % (normalize(folder_id, "utf7"), e))
+                    break
+
+        if connection is not None:
+            await connection.logout()
+
+    started = time.time()
+    print("Archiving %d folders over %d asyncio connections" % (len(changed), 1 + extra))
+    try:
+        await asyncio.gather(*[worker() for count in range(1 + extra)])
+    finally:
+        for count in range(extra):
+            slots.release()
+
+    elapsed = max(time.time() - started, 0.001)
+    print("Archived %d messages in %.1fs (%.1f messages/s)" % (totals['downloaded'], elapsed, totals['downloaded'] / elapsed))
+
+
+def download_folders(settings, changed, stats = None):
+    """
+    Runs the asyncio engine over pre-scanned folders, see mailutils.prescan_folders
+
+    The caller holds a slot of the server, see mailutils.server_slots, but
+    no connection anymore.
+    """
+    if settings.get('sync_mode', 'append') == 'qresync':
+        print("sync_mode qresync is not supported by the asyncio engine, only new messages are downloaded")
+
+    asyncio.run(download_folders_async(settings, changed, stats or FetchStats()))
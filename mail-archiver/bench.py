@@ -0,0 +1,97 @@
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+import click
+
+from .imapserver import start_server, synthetic_folders, load_maildir
+from .mailutils import account_traffic, connect_account, get_mail_folders
+from .run import prepare_dirs, walk_mailfolders
+from .storage import close_store, open_store
+from .utils import humansize
+
+
+def count_messages(settings, mailfolders):
+    """
+    Counts messages stored in the selected folders
+    """
+    store = open_store(settings)
+
+    return sum(store.count(folder_id) for folder_id in mailfolders if mailfolders[folder_id]["selected"])
+
+@click.command()
+@click.option('--folders', default=4, help='Number of synthetic folders.')
+@click.option('--messages', default=500, help='Messages per synthetic folder.')
+@click.option('--size', default=4096, help='Approximate size of synthetic messages, in bytes.')
+@click.option('--maildir', default=None, help='Serve an existing local Maildir instead of synthetic folders.')
+@click.option('--latency', default=0.0, help='Seconds added to every IMAP command.')
+@click.option('--bandwidth', default=0, help='Server bandwidth limit, in bytes per second.')
+@click.option('--drop-after', default=0, help='Drop connections after this many fetched messages.')
+@click.option('--max-drops', default=0, help='How many connections may be dropped in total.')
+@click.option('--batch-size', default=200, help='fetch_batch_size setting.')
+@click.option('--connections', default=1, help='connections setting.')
+@click.option('--compress/--no-compress', default=True, help='compress setting.')
+@click.option('--engine', default='imaplib', type=click.Choice(['imaplib', 'asyncio']), help='engine setting.')
+@click.option('--pipeline-depth', default=4, help='pipeline_depth setting (asyncio engine).')
+@click.option('--storage', default='maildir', type=click.Choice(['maildir', 'pack']), help='storage setting.')
+@click.option('--verbose', is_flag=True, help='Show the archiver output.')
+def benchmark(folders, messages, size, maildir, latency, bandwidth, drop_after, max_drops, batch_size, connections, compress, engine, pipeline_depth, storage, verbose):
+    """Benchmark the fetch path against a local IMAP stand-in server."""
+    if maildir:
+        store = load_maildir(maildir)
+    else:
+        store = synthetic_folders(["INBOX"] + ["Folder %d" % count for count in range(1, folders)], messages=messages, size=size)
+
+    server = start_server(
+        store,
+        latency=latency,
+        bandwidth=bandwidth,
+        drop_after=drop_after,
+        max_drops=max_drops,
+    )
+    output = tempfile.mkdtemp(prefix="mail-archiver-bench-")
+    settings = prepare_dirs({
+        'domain': '127.0.0.1',
+        'port': server.port,
+        'username': server.username,
+        'password': server.password,
+        'ssl': False,
+        'compress': compress,
+        'engine': engine,
+        'pipeline_depth': pipeline_depth,
+        'storage': storage,
+        'folders': ['--all'],
+        'fetch_batch_size': batch_size,
+        'connections': connections,
+        'max_connections_per_server': max(connections, 1),
+        'retry_backoff': 0.1,
+        'output': output + "/",
+    })
+
+    click.echo(click.style("Serving %d messages in %d folders on port %d" % (sum(len(folder["messages"]) for folder in store.values()), len(store), server.port), fg='blue'))
+    try:
+        started = time.time()
+        log = io.StringIO()
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(log):
+            connection = connect_account(settings)
+            mailfolders = get_mail_folders(settings, connection)
+            walk_mailfolders(settings, connection, mailfolders)
+        elapsed = max(time.time() - started, 0.001)
+
+        archived = count_messages(settings, mailfolders)
+        sent = server.stats.get("bytes_sent", 0)
+        click.echo("Messages archived:  %d" % archived)
+        click.echo("Elapsed:            %.2fs" % elapsed)
+        click.echo("Messages/s:         %.1f" % (archived / elapsed))
+        click.echo("Bytes/s:            %s/s (%s sent by the server)" % (humansize(sent / elapsed), humansize(sent)))
+        click.echo("Round trips:        %d" % server.stats.get("round_trips", 0))
+        click.echo("Dropped:            %d connections" % server.stats.get("drops", 0))
+        click.echo(account_traffic(settings).summary())
+    finally:
+        server.shutdown()
+        close_store(settings)
+        shutil.rmtree(output, ignore_errors=True)
+
+if __name__ == '__main__':
+    benchmark()
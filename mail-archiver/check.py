@@ -0,0 +1,161 @@
+"""
+Regression checks against the local IMAP stand-in server
+
+Every check archives a small synthetic mailbox served by imapserver, with the
+faults or changes a real server would bring, and returns the problems found.
+"""
+import contextlib
+import io
+import shutil
+import tempfile
+import click
+
+from .bench import count_messages
+from .database import DIRTY, VANISHED
+from .imapserver import expunge_message, set_flags, start_server, synthetic_folders
+from .mailutils import connect_account, get_mail_folders, open_index
+from .run import prepare_dirs, walk_mailfolders
+from .storage import close_store
+from .utils import account_id
+
+
+def check_settings(server, output, **options):
+    """
+    Returns the settings of an account archiving the stand-in server
+    """
+    settings = {
+        'domain': '127.0.0.1',
+        'port': server.port,
+        'username': server.username,
+        'password': server.password,
+        'ssl': False,
+        'folders': ['--all'],
+        'retry_backoff': 0.1,
+        'output': output + "/",
+    }
+    settings.update(options)
+
+    return prepare_dirs(settings)
+
+def archive_quietly(settings):
+    """
+    Downloads the selected folders of an account, hiding its output
+
+    Returns (mailfolders, stats)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection = connect_account(settings)
+        try:
+            mailfolders = get_mail_folders(settings, connection)
+            stats = walk_mailfolders(settings, connection, mailfolders)
+        finally:
+            close_store(settings)
+            try:
+                connection.logout()
+            except Exception:
+                pass
+
+    return mailfolders, stats
+
+def archive_store(store, engine, **faults):
+    """
+    Archives a mail store served with the given faults, see start_server
+
+    Returns ({folder: archived messages}, failed messages, dropped connections)
+    """
+    server = start_server(store, **faults)
+    output = tempfile.mkdtemp(prefix="mail-archiver-check-")
+    settings = check_settings(server, output, engine=engine, fetch_batch_size=10)
+    try:
+        mailfolders, stats = archive_quietly(settings)
+        archived = {folder_id: count_messages(settings, {folder_id: mailfolders[folder_id]}) for folder_id in mailfolders}
+    finally:
+        server.shutdown()
+        close_store(settings)
+        shutil.rmtree(output, ignore_errors=True)
+
+    return archived, len(stats.failed), server.stats.get("drops", 0)
+
+def check_dropped_connection(engine):
+    """
+    The server drops connections in the middle of a fetch: after reconnecting,
+    the archive must hold the same messages as without any drop
+    """
+    store = synthetic_folders(("INBOX", "Other"), messages=30, size=500)
+    expected, _, _ = archive_store(store, engine)
+    archived, failed, drops = archive_store(store, engine, drop_after=7, max_drops=2)
+
+    problems = []
+    if not drops:
+        problems.append("the server dropped no connection")
+    if archived != expected:
+        problems.append("archived %s instead of %s" % (archived, expected))
+    if failed:
+        problems.append("%d messages failed" % failed)
+
+    return problems
+
+def check_qresync_changes():
+    """
+    Messages are expunged and flagged on the server between two runs with
+    sync_mode: qresync: the expunged ones must be marked vanished but kept in
+    the archive, the flag change recorded
+    """
+    store = synthetic_folders(("INBOX",), messages=12, size=500)
+    server = start_server(store)
+    output = tempfile.mkdtemp(prefix="mail-archiver-check-")
+    settings = check_settings(server, output, sync_mode='qresync')
+    problems = []
+    try:
+        mailfolders, _ = archive_quietly(settings)
+        expected = count_messages(settings, mailfolders)
+        for uid in (2, 5):
+            expunge_message(store, "INBOX", uid)
+        set_flags(store, "INBOX", 3, ["\\Seen"])
+        mailfolders, _ = archive_quietly(settings)
+
+        archived = count_messages(settings, mailfolders)
+        db = open_index(settings)
+        try:
+            changes = db.get_changes(account_id(settings), "INBOX")
+        finally:
+            db.close()
+        vanished = [uid for _, _, uid, _, state in changes if state == VANISHED]
+        flagged = [(uid, flags) for _, _, uid, flags, state in changes if state == DIRTY]
+        if archived != expected:
+            problems.append("%d messages archived instead of %d" % (archived, expected))
+        if vanished != [2, 5]:
+            problems.append("vanished UIDs %s instead of [2, 5]" % vanished)
+        if flagged != [(3, "S")]:
+            problems.append("flag changes %s instead of [(3, 'S')]" % flagged)
+    finally:
+        server.shutdown()
+        close_store(settings)
+        shutil.rmtree(output, ignore_errors=True)
+
+    return problems
+
+CHECKS = [
+    ("connection dropped mid-fetch (imaplib)", check_dropped_connection, ('imaplib',)),
+    ("connection dropped mid-fetch (asyncio)", check_dropped_connection, ('asyncio',)),
+    # The asyncio engine only downloads new messages
+    ("expunge and flag change with qresync", check_qresync_changes, ()),
+]
+
+@click.command()
+def check():
+    """Run regression checks against a local IMAP stand-in server."""
+    failed = 0
+    for title, run_check, args in CHECKS:
+        problems = run_check(*args)
+        if problems:
+            failed += 1
+            click.echo(click.style("FAIL %s: %s" % (title, "; ".join(problems)), fg='red'))
+        else:
+            click.echo(click.style("ok   %s" % title, fg='green'))
+
+    if failed:
+        raise click.ClickException("%d of %d checks failed" % (failed, len(CHECKS)))
+
+if __name__ == '__main__':
+    check()
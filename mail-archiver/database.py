@@ -0,0 +1,373 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    message_id TEXT,
+    uid INTEGER,
+    flags TEXT,
+    state TEXT,
+    sha256 TEXT,
+    UNIQUE (account, folder, message_id, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_lookup ON messages (account, folder, message_id);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER,
+    last_uid INTEGER,
+    highestmodseq INTEGER,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    account TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    message_id TEXT,
+    hash TEXT,
+    date TEXT,
+    subject TEXT,
+    sender TEXT,
+    recipient TEXT,
+    parent TEXT,
+    refs TEXT,
+    size INTEGER,
+    PRIMARY KEY (account, sha256)
+);
+CREATE TABLE IF NOT EXISTS folder_status (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    messages INTEGER,
+    uidnext INTEGER,
+    uidvalidity INTEGER,
+    highestmodseq INTEGER,
+    PRIMARY KEY (account, folder)
+);
+"""
+
+# Columns added after the first release, created on older index files
+COLUMNS = {
+    'messages': [('flags', 'TEXT'), ('state', 'TEXT'), ('sha256', 'TEXT'), ('key', 'TEXT')],
+    'checkpoints': [('highestmodseq', 'INTEGER')],
+}
+
+# Values of messages.state
+DIRTY = 'dirty'
+VANISHED = 'vanished'
+
+
+class MessageIndex:
+    """
+    SQLite backed index of archived messages and per-folder sync checkpoints
+
+    One instance can be shared among threads, every access is serialized.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        for table, columns in COLUMNS.items():
+            existing = [row[1] for row in self.connection.execute("PRAGMA table_info(%s)" % table)]
+            for name, kind in columns:
+                if name not in existing:
+                    self.connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, kind))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS messages_content ON messages (account, sha256)")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def has_message(self, account, folder, message_id):
+        """
+        Returns True if a message was already archived in a folder
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM messages WHERE account = ? AND folder = ? AND message_id = ? LIMIT 1",
+                (account, folder, message_id),
+            ).fetchone()
+
+        return row is not None
+
+    def add_messages(self, rows):
+        """
+        Records archived messages, rows of (account, folder, message_id, uid[,
+        flags, sha256, key]), in one transaction
+        """
+        if not rows:
+            return
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO messages (account, folder, message_id, uid, flags, sha256, key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [tuple(row) + (None,) * (7 - len(row)) for row in rows],
+            )
+
+    def add_metadata(self, account, records):
+        """
+        Records the metadata of stored messages, records of (sha256, metadata)
+        as returned by utils.message_metadata, with their size
+        """
+        if not records:
+            return
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata (account, sha256, message_id, hash, date, subject, sender, recipient, parent, refs, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(
+                    account,
+                    sha256,
+                    metadata["id"],
+                    metadata["hash"],
+                    json.dumps(list(metadata["date"])),
+                    metadata["subject"],
+                    metadata["from"],
+                    metadata["to"],
+                    metadata["parent"],
+                    metadata["references"],
+                    metadata["size"],
+                ) for sha256, metadata in records],
+            )
+
+    def get_metadata(self, account):
+        """
+        Returns [(folder, key, sha256, metadata)] of all the archived messages
+        of an account with known metadata, in folder and UID order, in one query
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT messages.folder, messages.key, messages.sha256, metadata.message_id, metadata.hash, metadata.date, metadata.subject, metadata.sender, metadata.recipient, metadata.parent, metadata.refs, metadata.size"
+                " FROM messages JOIN metadata ON metadata.account = messages.account AND metadata.sha256 = messages.sha256"
+                " WHERE messages.account = ? AND messages.key IS NOT NULL AND messages.state IS NOT ? ORDER BY messages.folder, messages.uid",
+                (account, VANISHED),
+            ).fetchall()
+
+        return [(folder, key, sha256, {
+            "id": message_id,
+            "hash": hash,
+            "date": tuple(json.loads(date)),
+            "subject": subject,
+            "from": sender,
+            "to": recipient,
+            "parent": parent,
+            "references": refs,
+            "size": size,
+        }) for folder, key, sha256, message_id, hash, date, subject, sender, recipient, parent, refs, size in rows]
+
+    def get_message_folders(self, account, sha256):
+        """
+        Returns the folders a stored message, by content hash, is filed in
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT folder FROM messages WHERE account = ? AND sha256 = ? AND state IS NOT ? ORDER BY folder",
+                (account, sha256, VANISHED),
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def update_flags(self, account, folder, changes):
+        """
+        Stores new flags of archived messages, changes of (uid, flags), and
+        marks them dirty
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE messages SET flags = ?, state = ? WHERE account = ? AND folder = ? AND uid = ? AND flags IS NOT ?",
+                [(flags, DIRTY, account, folder, uid, flags) for uid, flags in changes],
+            )
+
+    def forget_uids(self, account, folder):
+        """
+        Detaches the archived messages of a folder from their UIDs, once its
+        UIDVALIDITY changed, until set_uids finds them again
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE messages SET uid = NULL WHERE account = ? AND folder = ?", (account, folder))
+
+    def set_uids(self, account, folder, found):
+        """
+        Records the UIDs of archived messages found again in a folder, found
+        of (message_id, uid), on those without UID; found again, a message
+        is no longer vanished
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE messages SET uid = ?, state = CASE WHEN state = ? THEN NULL ELSE state END"
+                " WHERE rowid = (SELECT rowid FROM messages WHERE account = ? AND folder = ? AND message_id = ? AND uid IS NULL LIMIT 1)",
+                [(uid, VANISHED, account, folder, message_id) for message_id, uid in found],
+            )
+
+    def mark_vanished(self, account, folder, uids):
+        """
+        Marks archived messages expunged from the server as vanished
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE messages SET state = ? WHERE account = ? AND folder = ? AND uid = ?",
+                [(VANISHED, account, folder, uid) for uid in uids],
+            )
+
+    def get_folder_digests(self, account, folder):
+        """
+        Returns the content hashes of the messages of a folder, in UID order
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT sha256 FROM messages WHERE account = ? AND folder = ? AND sha256 IS NOT NULL AND state IS NOT ? GROUP BY sha256 ORDER BY MIN(uid)",
+                (account, folder, VANISHED),
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def get_digests(self, account, vanished = True):
+        """
+        Returns the content hashes of all the messages of an account, those
+        marked vanished included unless vanished is False
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT sha256 FROM messages WHERE account = ? AND sha256 IS NOT NULL AND (? OR state IS NOT ?)",
+                (account, vanished, VANISHED),
+            ).fetchall()
+
+        return set(row[0] for row in rows)
+
+    def get_vanished(self, account):
+        """
+        Returns [(folder, key)] of the stored messages marked vanished
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT folder, key FROM messages WHERE account = ? AND state = ? AND key IS NOT NULL ORDER BY folder, uid",
+                (account, VANISHED),
+            ).fetchall()
+
+    def get_changes(self, account, folder = None):
+        """
+        Returns [(folder, message_id, uid, flags, state)] of the messages marked
+        dirty or vanished, for later stages to update
+        """
+        query = "SELECT folder, message_id, uid, flags, state FROM messages WHERE account = ? AND state IS NOT NULL"
+        params = (account,)
+        if folder is not None:
+            query += " AND folder = ?"
+            params += (folder,)
+
+        with self.lock:
+            return self.connection.execute(query + " ORDER BY folder, uid", params).fetchall()
+
+    def clear_changes(self, account, folder = None):
+        """
+        Acknowledges the changes of get_changes: dirty messages become clean,
+        vanished ones stay marked, their messages are kept in the archive
+        until drop_vanished
+        """
+        condition = "account = ?" + (" AND folder = ?" if folder is not None else "")
+        params = (account,) if folder is None else (account, folder)
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE messages SET state = NULL WHERE state = ? AND " + condition, (DIRTY,) + params)
+
+    def drop_vanished(self, account):
+        """
+        Forgets the messages marked vanished, once they left the store, see
+        storage.remove_vanished
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM messages WHERE account = ? AND state = ?", (account, VANISHED))
+
+    def get_checkpoint(self, account, folder):
+        """
+        Returns the stored UIDVALIDITY / last archived UID / HIGHESTMODSEQ of a
+        folder, if any
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT uidvalidity, last_uid, highestmodseq FROM checkpoints WHERE account = ? AND folder = ?",
+                (account, folder),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        return {'uidvalidity': row[0], 'last_uid': row[1], 'highestmodseq': row[2]}
+
+    def set_checkpoint(self, account, folder, uidvalidity, last_uid, highestmodseq = None):
+        """
+        Stores the UIDVALIDITY / last archived UID / HIGHESTMODSEQ of a folder
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints (account, folder, uidvalidity, last_uid, highestmodseq) VALUES (?, ?, ?, ?, ?)",
+                (account, folder, uidvalidity, last_uid, highestmodseq),
+            )
+
+    def get_folder_statuses(self, account):
+        """
+        Returns {folder: {messages, uidnext, uidvalidity, highestmodseq}} as of
+        the last complete sync of every folder of an account
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT folder, messages, uidnext, uidvalidity, highestmodseq FROM folder_status WHERE account = ?",
+                (account,),
+            ).fetchall()
+
+        return {
+            row[0]: {'messages': row[1], 'uidnext': row[2], 'uidvalidity': row[3], 'highestmodseq': row[4]}
+            for row in rows
+        }
+
+    def set_folder_status(self, account, folder, status):
+        """
+        Stores the STATUS of a folder once it is completely synced
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO folder_status (account, folder, messages, uidnext, uidvalidity, highestmodseq) VALUES (?, ?, ?, ?, ?, ?)",
+                (account, folder, status.get('messages'), status.get('uidnext'), status.get('uidvalidity'), status.get('highestmodseq')),
+            )
+
+    def migrate_tinydb(self, legacy_path, account):
+        """
+        Imports, once, the messages and checkpoints of a former TinyDB db.json
+        """
+        if self.get_meta('tinydb_migrated') or not os.path.exists(legacy_path):
+            return
+
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except ValueError:
+            legacy = {}
+
+        for checkpoint in legacy.get('checkpoints', {}).values():
+            self.set_checkpoint(checkpoint.get('account', account), checkpoint.get('mail_folder'), checkpoint.get('uidvalidity'), checkpoint.get('last_uid'))
+
+        self.add_messages([
+            (account, row.get('mail_folder'), row.get('message_id'), None)
+            for row in legacy.get('_default', {}).values()
+        ])
+        print("Migrated %d messages from %s" % (len(legacy.get('_default', {})), legacy_path))
+        self.set_meta('tinydb_migrated', legacy_path)
@@ -0,0 +1,111 @@
+"""
+Message filters of an account, the `filters` section of the config
+
+Filters are compiled to IMAP SEARCH criteria so the server leaves out unwanted
+messages before anything is transferred. Rules the server cannot be asked for
+are evaluated on the fetched headers instead.
+"""
+import datetime
+from email.utils import parsedate_to_datetime
+
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+DEFAULT_FILTERS = {
+    'exclude_subjects': ['* SPAM *'],
+}
+
+
+def account_filters(settings):
+    """
+    Returns the filters of an account, with the defaults it does not override
+    """
+    filters = dict(DEFAULT_FILTERS)
+    filters.update(settings.get('filters') or {})
+
+    return filters
+
+def parse_date(value):
+    """
+    Returns a date out of a YAML date or an ISO formatted string
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+
+    return datetime.date.fromisoformat(str(value))
+
+def search_date(value):
+    """
+    Formats a date for IMAP SEARCH, e.g. 01-Jan-2020, whatever the locale
+    """
+    return "%02d-%s-%d" % (value.day, MONTHS[value.month - 1], value.year)
+
+def search_string(value):
+    """
+    Returns value as an IMAP quoted string, or None when it would need a
+    literal (non ASCII or line breaks)
+    """
+    if not value.isascii() or "\r" in value or "\n" in value:
+        return None
+
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+def compile_filters(filters):
+    """
+    Splits filters into IMAP SEARCH criteria and the rules left to evaluate on
+    headers, see excluded
+
+    Returns (criteria, rules)
+    """
+    criteria = []
+    rules = {}
+    if filters.get('since'):
+        criteria.append("SENTSINCE %s" % search_date(parse_date(filters['since'])))
+    if filters.get('before'):
+        criteria.append("SENTBEFORE %s" % search_date(parse_date(filters['before'])))
+
+    for name, key in (('exclude_subjects', 'SUBJECT'), ('exclude_senders', 'FROM')):
+        for value in filters.get(name) or []:
+            quoted = search_string(str(value))
+            if quoted is None:
+                rules.setdefault(name, []).append(str(value))
+            else:
+                criteria.append("NOT %s %s" % (key, quoted))
+
+    if filters.get('max_size'):
+        criteria.append("NOT LARGER %d" % int(filters['max_size']))
+
+    return criteria, rules
+
+def excluded(rules, headers, size = None):
+    """
+    Returns the name of the first rule excluding a message, given its parsed
+    headers and size, or None
+    """
+    subject = str(headers['Subject'] or '').lower()
+    for value in rules.get('exclude_subjects') or []:
+        if str(value).lower() in subject:
+            return 'exclude_subjects'
+
+    sender = str(headers['From'] or '').lower()
+    for value in rules.get('exclude_senders') or []:
+        if str(value).lower() in sender:
+            return 'exclude_senders'
+
+    if rules.get('max_size') and size is not None and size > int(rules['max_size']):
+        return 'max_size'
+
+    if rules.get('since') or rules.get('before'):
+        try:
+            sent = parsedate_to_datetime(str(headers['Date'])).date()
+        except (TypeError, ValueError, IndexError):
+            # Undated messages are kept
+            return None
+        if rules.get('since') and sent < parse_date(rules['since']):
+            return 'since'
+        if rules.get('before') and sent >= parse_date(rules['before']):
+            return 'before'
+
+    return None
@@ -0,0 +1,679 @@
+"""
+In-process IMAP stand-in server
+
+Serves a synthetic (or an existing local Maildir) mail store over IMAP so that
+the fetch path can be measured and exercised without a real mail server.
+Latency, bandwidth limits and dropped connections can be injected.
+"""
+import email.utils
+import mailbox
+import random
+import re
+import socketserver
+import threading
+import time
+import zlib
+from email.parser import BytesHeaderParser
+
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def synthetic_folders(folders = ("INBOX",), messages = 100, size = 2048, seed = 0):
+    """
+    Returns a synthetic mail store: a few folders full of generated messages
+    """
+    rnd = random.Random(seed)
+    words = ["archive", "mail", "report", "meeting", "invoice", "project", "update", "lunch", "server", "backup"]
+    store = {}
+    count = 0
+    for folder_id in folders:
+        store[folder_id] = {"uidvalidity": 1000 + len(store), "uidnext": 1, "highestmodseq": 1, "vanished": [], "messages": []}
+        for _ in range(messages):
+            count += 1
+            date = time.mktime((2020, 1, 1, 12, 0, 0, 0, 1, -1)) + count * 3600
+            subject = " ".join(rnd.choice(words) for _ in range(4))
+            if rnd.random() < 0.05:
+                subject = "* SPAM * %s" % subject
+            body = " ".join(rnd.choice(words) for _ in range(max(1, size // 7)))
+            raw = (
+                "Message-ID: <%d.%d@stand-in.local>\r\n"
+                "Date: %s\r\n"
+                "From: Sender %d <sender%d@stand-in.local>\r\n"
+                "To: archive@stand-in.local\r\n"
+                "Subject: %s\r\n"
+                "Content-Type: text/plain; charset=utf-8\r\n"
+                "\r\n"
+                "%s\r\n"
+            ) % (seed, count, email.utils.formatdate(date), count % 7, count % 7, subject, body)
+            add_message(store, folder_id, raw.encode())
+
+    return store
+
+
+def load_maildir(maildir_raw):
+    """
+    Returns a mail store with all folders found in a local Maildir
+    """
+    store = {}
+    local_maildir = mailbox.Maildir(maildir_raw, factory=None, create=False)
+    for folder_name in local_maildir.list_folders():
+        folder = local_maildir.get_folder(folder_name)
+        folder_id = folder_name.replace(".", "/")
+        store[folder_id] = {"uidvalidity": 1000 + len(store), "uidnext": 1, "highestmodseq": 1, "vanished": [], "messages": []}
+        for key in folder.iterkeys():
+            add_message(store, folder_id, folder.get_bytes(key).replace(b"\r\n", b"\n").replace(b"\n", b"\r\n"))
+
+    return store
+
+
+def add_message(store, folder_id, raw, flags = None):
+    """
+    Appends a message to a folder of the mail store, returns its UID
+    """
+    folder = store[folder_id]
+    uid = folder["uidnext"]
+    folder["uidnext"] += 1
+    folder["highestmodseq"] += 1
+    folder["messages"].append({
+        "uid": uid,
+        "raw": raw,
+        "flags": list(flags or []),
+        "modseq": folder["highestmodseq"],
+    })
+
+    return uid
+
+
+def set_flags(store, folder_id, uid, flags):
+    """
+    Replaces the flags of a message, as another client would
+    """
+    folder = store[folder_id]
+    for message in folder["messages"]:
+        if message["uid"] == uid:
+            folder["highestmodseq"] += 1
+            message["flags"] = list(flags)
+            message["modseq"] = folder["highestmodseq"]
+
+
+def expunge_message(store, folder_id, uid):
+    """
+    Removes a message from a folder, remembering when for QRESYNC
+    """
+    folder = store[folder_id]
+    folder["highestmodseq"] += 1
+    folder["messages"] = [message for message in folder["messages"] if message["uid"] != uid]
+    folder["vanished"].append((uid, folder["highestmodseq"]))
+
+
+def header_block(raw):
+    """
+    Returns the header block of a raw message, including the blank line
+    """
+    pos = raw.find(b"\r\n\r\n")
+    if pos < 0:
+        return raw
+
+    return raw[:pos + 4]
+
+
+def header_fields(raw, fields, exclude = False):
+    """
+    Returns the selected header fields of a raw message, as BODY[HEADER.FIELDS] does
+    """
+    fields = [field.lower() for field in fields]
+    result = []
+    keep = False
+    for line in header_block(raw).split(b"\r\n"):
+        if not line:
+            continue
+
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                result.append(line)
+            continue
+
+        name = line.split(b":", 1)[0].decode(errors="replace").strip().lower()
+        keep = (name in fields) != exclude
+        if keep:
+            result.append(line)
+
+    return b"\r\n".join(result) + b"\r\n\r\n"
+
+
+def imap_date(timestamp):
+    """
+    Formats a timestamp as an IMAP date-time
+    """
+    parts = time.gmtime(timestamp)
+    return "%02d-%s-%04d %02d:%02d:%02d +0000" % (
+        parts.tm_mday, MONTHS[parts.tm_mon - 1], parts.tm_year, parts.tm_hour, parts.tm_min, parts.tm_sec)
+
+
+def parse_search_date(value):
+    """
+    Parses an IMAP search date (01-Jan-2020) to a timestamp
+    """
+    day, month, year = value.split("-")
+    return time.mktime((int(year), MONTHS.index(month.capitalize()) + 1, int(day), 0, 0, 0, 0, 1, -1))
+
+
+def tokenize(line):
+    """
+    Splits an IMAP command line into atoms, strings and (nested) lists
+    """
+    stack = [[]]
+    pos = 0
+    while pos < len(line):
+        char = line[pos]
+        if char == " ":
+            pos += 1
+        elif char == "(":
+            stack.append([])
+            pos += 1
+        elif char == ")":
+            done = stack.pop()
+            stack[-1].append(done)
+            pos += 1
+        elif char == '"':
+            value = ""
+            pos += 1
+            while pos < len(line) and line[pos] != '"':
+                if line[pos] == "\\":
+                    pos += 1
+                value += line[pos]
+                pos += 1
+            stack[-1].append(value)
+            pos += 1
+        else:
+            start = pos
+            depth = 0
+            while pos < len(line):
+                if line[pos] == "[":
+                    depth += 1
+                elif line[pos] == "]":
+                    depth -= 1
+                elif depth == 0 and line[pos] in " ()":
+                    break
+                pos += 1
+            stack[-1].append(line[start:pos])
+
+    while len(stack) > 1:
+        done = stack.pop()
+        stack[-1].append(done)
+
+    return stack[0]
+
+
+def format_set(uids):
+    """
+    Returns the compact IMAP sequence set of a list of numbers
+    """
+    ranges = []
+    for number in sorted(uids):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+
+    return ",".join(str(start) if start == end else "%d:%d" % (start, end) for start, end in ranges)
+
+
+def parse_set(value, maximum):
+    """
+    Returns a predicate for an IMAP sequence set, e.g. 1:4,7,9:*
+    """
+    ranges = []
+    for part in value.split(","):
+        if ":" in part:
+            low, high = part.split(":", 1)
+        else:
+            low, high = part, part
+        low = maximum if low == "*" else int(low)
+        high = maximum if high == "*" else int(high)
+        ranges.append((min(low, high), max(low, high)))
+
+    return lambda number: any(low <= number <= high for low, high in ranges)
+
+
+class IMAPStandInHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one IMAP client connection
+    """
+
+    def setup(self):
+        self.buffer = b""
+        self.decompressor = None
+        self.compressor = None
+        self.selected = None
+        self.authenticated = False
+        self.enabled = set()
+        self.fetched = 0
+
+    def recv(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise ConnectionError("client went away")
+        self.server.count("bytes_received", len(data))
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.buffer += data
+
+    def readline(self):
+        while b"\r\n" not in self.buffer:
+            self.recv()
+        line, self.buffer = self.buffer.split(b"\r\n", 1)
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.recv()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        bandwidth = self.server.options.get("bandwidth")
+        if bandwidth:
+            time.sleep(len(data) / bandwidth)
+        self.request.sendall(data)
+        self.server.count("bytes_sent", len(data))
+
+    def read_command(self):
+        """
+        Reads a full command, resolving literals sent by the client
+        """
+        line = self.readline()
+        while True:
+            literal = re.search(rb"\{(\d+)\+?\}$", line)
+            if not literal:
+                return line.decode("utf-8", errors="replace")
+            if not line.endswith(b"+}"):
+                self.send("+ Ready for literal data\r\n")
+            data = self.read(int(literal.group(1)))
+            line = line[:literal.start()] + b'"' + data.replace(b'"', b'\\"') + b'"' + self.readline()
+
+    def handle(self):
+        self.send("* OK [CAPABILITY %s] IMAP stand-in ready\r\n" % " ".join(self.server.capabilities))
+        try:
+            while True:
+                line = self.read_command()
+                parts = line.split(" ", 2)
+                if len(parts) < 2:
+                    self.send("* BAD Missing tag or command\r\n")
+                    continue
+                tag, command = parts[0], parts[1].upper()
+                args = tokenize(parts[2]) if len(parts) > 2 else []
+
+                self.server.count("round_trips")
+                latency = self.server.options.get("latency")
+                if latency:
+                    time.sleep(latency)
+
+                use_uid = False
+                if command == "UID" and args:
+                    use_uid = True
+                    command = args[0].upper()
+                    args = args[1:]
+
+                method = getattr(self, "do_%s" % command.lower(), None)
+                if not method:
+                    self.send("%s BAD Unknown command %s\r\n" % (tag, command))
+                    continue
+
+                if not self.authenticated and command not in ("CAPABILITY", "NOOP", "LOGIN", "LOGOUT"):
+                    self.send("%s NO Not logged in\r\n" % tag)
+                    continue
+
+                if method(tag, args, use_uid) is False:
+                    return
+        except (ConnectionError, OSError):
+            return
+
+    def do_capability(self, tag, args, use_uid):
+        self.send("* CAPABILITY %s\r\n" % " ".join(self.server.capabilities))
+        self.send("%s OK CAPABILITY completed\r\n" % tag)
+
+    def do_noop(self, tag, args, use_uid):
+        self.send("%s OK NOOP completed\r\n" % tag)
+
+    def do_logout(self, tag, args, use_uid):
+        self.send("* BYE Logging out\r\n")
+        self.send("%s OK LOGOUT completed\r\n" % tag)
+        return False
+
+    def do_login(self, tag, args, use_uid):
+        if len(args) != 2 or (args[0], args[1]) != (self.server.username, self.server.password):
+            self.send("%s NO [AUTHENTICATIONFAILED] Invalid credentials\r\n" % tag)
+            return
+
+        self.authenticated = True
+        self.send("%s OK LOGIN completed\r\n" % tag)
+
+    def do_enable(self, tag, args, use_uid):
+        enabled = [arg for arg in args if arg.upper() in self.server.capabilities]
+        self.enabled.update(arg.upper() for arg in enabled)
+        # QRESYNC implies CONDSTORE (RFC 7162)
+        if "QRESYNC" in self.enabled:
+            self.enabled.add("CONDSTORE")
+        self.send("* ENABLED %s\r\n" % " ".join(enabled))
+        self.send("%s OK ENABLE completed\r\n" % tag)
+
+    def do_compress(self, tag, args, use_uid):
+        if "COMPRESS=DEFLATE" not in self.server.capabilities or not args or args[0].upper() != "DEFLATE":
+            self.send("%s NO Compression not supported\r\n" % tag)
+            return
+
+        self.send("%s OK DEFLATE active\r\n" % tag)
+        self.compressor = zlib.compressobj(wbits=-15)
+        self.decompressor = zlib.decompressobj(wbits=-15)
+        if self.buffer:
+            self.buffer = self.decompressor.decompress(self.buffer)
+
+    def do_list(self, tag, args, use_uid):
+        pattern = args[1] if len(args) > 1 else "*"
+        regex = "^" + re.escape(pattern).replace("\\*", ".*").replace("%", "[^/]*") + "$"
+        # LIST-STATUS (RFC 5819): LIST "" "*" RETURN (STATUS (MESSAGES UIDNEXT))
+        status_items = None
+        if len(args) > 3 and str(args[2]).upper() == "RETURN" and "LIST-STATUS" in self.server.capabilities:
+            options = args[3]
+            for pos in range(len(options) - 1):
+                if str(options[pos]).upper() == "STATUS":
+                    status_items = options[pos + 1]
+
+        for folder_id in self.server.store:
+            if re.match(regex, folder_id):
+                self.send('* LIST (\\HasNoChildren) "/" "%s"\r\n' % folder_id)
+                if status_items:
+                    self.send(self.status_response(folder_id, status_items))
+        self.send("%s OK LIST completed\r\n" % tag)
+
+    def status_response(self, folder_id, items):
+        """
+        Returns the untagged STATUS response of a folder
+        """
+        folder = self.server.store[folder_id]
+        values = {
+            "MESSAGES": len(folder["messages"]),
+            "UIDNEXT": folder["uidnext"],
+            "UIDVALIDITY": folder["uidvalidity"],
+            "UNSEEN": len([message for message in folder["messages"] if "\\Seen" not in message["flags"]]),
+            "RECENT": 0,
+            "HIGHESTMODSEQ": folder.get("highestmodseq", 1),
+        }
+        pairs = ["%s %d" % (item.upper(), values[item.upper()]) for item in items if item.upper() in values]
+
+        return '* STATUS "%s" (%s)\r\n' % (folder_id, " ".join(pairs))
+
+    def do_status(self, tag, args, use_uid):
+        if len(args) < 2 or args[0] not in self.server.store:
+            self.send("%s NO Mailbox does not exist\r\n" % tag)
+            return
+
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        self.send(self.status_response(args[0], items))
+        self.send("%s OK STATUS completed\r\n" % tag)
+
+    def do_select(self, tag, args, use_uid, readonly = False):
+        folder_id = args[0] if args else ""
+        if folder_id not in self.server.store:
+            self.selected = None
+            self.send("%s NO Mailbox does not exist\r\n" % tag)
+            return
+
+        # SELECT folder (CONDSTORE) or SELECT folder (QRESYNC (uidvalidity modseq))
+        parameters = args[1] if len(args) > 1 and isinstance(args[1], list) else []
+        qresync = None
+        for pos, parameter in enumerate(parameters):
+            if str(parameter).upper() == "CONDSTORE" and "CONDSTORE" in self.server.capabilities:
+                self.enabled.add("CONDSTORE")
+            elif str(parameter).upper() == "QRESYNC" and pos + 1 < len(parameters):
+                if "QRESYNC" not in self.enabled:
+                    self.send("%s BAD QRESYNC is not enabled\r\n" % tag)
+                    return
+                qresync = [int(value) for value in parameters[pos + 1][:2]]
+
+        self.selected = folder_id
+        folder = self.server.store[folder_id]
+        self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n")
+        self.send("* %d EXISTS\r\n" % len(folder["messages"]))
+        self.send("* 0 RECENT\r\n")
+        self.send("* OK [UIDVALIDITY %d] UIDs valid\r\n" % folder["uidvalidity"])
+        self.send("* OK [UIDNEXT %d] Predicted next UID\r\n" % folder["uidnext"])
+        if "CONDSTORE" in self.enabled:
+            self.send("* OK [HIGHESTMODSEQ %d] Highest\r\n" % folder["highestmodseq"])
+        if qresync and qresync[0] == folder["uidvalidity"]:
+            vanished = [uid for uid, modseq in folder["vanished"] if modseq > qresync[1]]
+            if vanished:
+                self.send("* VANISHED (EARLIER) %s\r\n" % format_set(vanished))
+            for seq, message in enumerate(folder["messages"], 1):
+                if message["modseq"] > qresync[1]:
+                    self.send("* %d FETCH (UID %d FLAGS (%s) MODSEQ (%d))\r\n" % (seq, message["uid"], " ".join(message["flags"]), message["modseq"]))
+        self.send("%s OK [%s] %s completed\r\n" % (tag, "READ-ONLY" if readonly else "READ-WRITE", "EXAMINE" if readonly else "SELECT"))
+
+    def do_examine(self, tag, args, use_uid):
+        return self.do_select(tag, args, use_uid, readonly=True)
+
+    def messages(self):
+        return self.server.store[self.selected]["messages"] if self.selected else []
+
+    def matches(self, criteria, seq, message):
+        """
+        Evaluates a list of search keys against a message
+        """
+        pos = 0
+        while pos < len(criteria):
+            matched, pos = self.match_key(criteria, pos, seq, message)
+            if not matched:
+                return False
+
+        return True
+
+    def match_key(self, criteria, pos, seq, message):
+        """
+        Evaluates the search key at pos, returns (matched, next position)
+        """
+        key = criteria[pos]
+        pos += 1
+        if isinstance(key, list):
+            return self.matches(key, seq, message), pos
+
+        upper = key.upper()
+        if upper == "ALL":
+            return True, pos
+        if upper == "NOT":
+            matched, pos = self.match_key(criteria, pos, seq, message)
+            return not matched, pos
+        if upper == "OR":
+            first, pos = self.match_key(criteria, pos, seq, message)
+            second, pos = self.match_key(criteria, pos, seq, message)
+            return first or second, pos
+        if upper == "UID":
+            return parse_set(criteria[pos], self.max_uid())(message["uid"]), pos + 1
+        if upper in ("SINCE", "BEFORE", "ON", "SENTSINCE", "SENTBEFORE", "SENTON"):
+            value = parse_search_date(criteria[pos])
+            date = email.utils.parsedate(self.header(message, "Date") or "")
+            day = time.mktime(date[:3] + (0, 0, 0, 0, 1, -1)) if date else 0
+            if upper.endswith("SINCE"):
+                return day >= value, pos + 1
+            if upper.endswith("BEFORE"):
+                return day < value, pos + 1
+            return day == value, pos + 1
+        if upper in ("SUBJECT", "FROM", "TO", "CC"):
+            return criteria[pos].lower() in self.header(message, upper).lower(), pos + 1
+        if upper == "HEADER":
+            return criteria[pos + 1].lower() in self.header(message, criteria[pos]).lower(), pos + 2
+        if upper == "LARGER":
+            return len(message["raw"]) > int(criteria[pos]), pos + 1
+        if upper == "SMALLER":
+            return len(message["raw"]) < int(criteria[pos]), pos + 1
+        if upper == "CHARSET":
+            return True, pos + 1
+        if re.match(r"^[\d*][\d:,*]*$", key):
+            return parse_set(key, len(self.messages()))(seq), pos
+
+        raise ValueError("Unsupported search key %s" % key)
+
+    def header(self, message, name):
+        headers = BytesHeaderParser().parsebytes(header_block(message["raw"]))
+        return str(headers.get(name, ""))
+
+    def max_uid(self):
+        messages = self.messages()
+        return messages[-1]["uid"] if messages else 0
+
+    def do_search(self, tag, args, use_uid):
+        if not self.selected:
+            self.send("%s BAD No mailbox selected\r\n" % tag)
+            return
+
+        try:
+            found = [
+                str(message["uid"] if use_uid else seq)
+                for seq, message in enumerate(self.messages(), 1)
+                if self.matches(args, seq, message)
+            ]
+        except (ValueError, IndexError) as e:
+            self.send("%s BAD %s\r\n" % (tag, e))
+            return
+
+        self.send("* SEARCH%s\r\n" % "".join(" " + number for number in found))
+        self.send("%s OK SEARCH completed\r\n" % tag)
+
+    def do_fetch(self, tag, args, use_uid):
+        if not self.selected or len(args) < 2:
+            self.send("%s BAD No mailbox selected\r\n" % tag)
+            return
+
+        messages = self.messages()
+        wanted = parse_set(args[0], self.max_uid() if use_uid else len(messages))
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [item.upper() if isinstance(item, str) else item for item in items]
+        if use_uid and "UID" not in items:
+            items = ["UID"] + items
+
+        # FETCH set items (CHANGEDSINCE modseq), see RFC 7162
+        changedsince = None
+        modifiers = args[2] if len(args) > 2 and isinstance(args[2], list) else []
+        if len(modifiers) == 2 and str(modifiers[0]).upper() == "CHANGEDSINCE" and "CONDSTORE" in self.server.capabilities:
+            self.enabled.add("CONDSTORE")
+            changedsince = int(modifiers[1])
+            if "MODSEQ" not in items:
+                items.append("MODSEQ")
+
+        drop_after = self.server.options.get("drop_after")
+        for seq, message in enumerate(messages, 1):
+            if not wanted(message["uid"] if use_uid else seq):
+                continue
+            if changedsince is not None and message["modseq"] <= changedsince:
+                continue
+
+            if drop_after and self.fetched >= drop_after and self.server.drop():
+                self.request.close()
+                return False
+
+            response = ("* %d FETCH (" % seq).encode()
+            first = True
+            for item in items:
+                response += b"" if first else b" "
+                first = False
+                response += self.fetch_item(item, message)
+            self.send(response + b")\r\n")
+            self.fetched += 1
+            self.server.count("messages_sent")
+
+        self.send("%s OK FETCH completed\r\n" % tag)
+
+    def fetch_item(self, item, message):
+        """
+        Returns the response bytes for one FETCH data item
+        """
+        raw = message["raw"]
+        if item == "UID":
+            return b"UID %d" % message["uid"]
+        if item == "FLAGS":
+            return ("FLAGS (%s)" % " ".join(message["flags"])).encode()
+        if item == "MODSEQ":
+            return b"MODSEQ (%d)" % message["modseq"]
+        if item == "RFC822.SIZE":
+            return b"RFC822.SIZE %d" % len(raw)
+        if item == "INTERNALDATE":
+            date = email.utils.parsedate(self.header(message, "Date") or "")
+            return ('INTERNALDATE "%s"' % imap_date(time.mktime(date) if date else 0)).encode()
+
+        name, data = item, raw
+        if item in ("RFC822.HEADER", "BODY[HEADER]", "BODY.PEEK[HEADER]"):
+            data = header_block(raw)
+        elif item.startswith("BODY"):
+            section = re.match(r"^BODY(?:\.PEEK)?\[(.*)\]$", item, re.S)
+            if not section:
+                raise ValueError("Unsupported fetch item %s" % item)
+            section = section.group(1)
+            fields = re.match(r"^HEADER\.FIELDS(\.NOT)? \((.*)\)$", section, re.S | re.I)
+            if fields:
+                data = header_fields(raw, fields.group(2).split(), exclude=bool(fields.group(1)))
+            elif section.upper() == "TEXT":
+                data = raw[len(header_block(raw)):]
+            name = "BODY[%s]" % section
+        elif item != "RFC822":
+            raise ValueError("Unsupported fetch item %s" % item)
+
+        return ("%s {%d}\r\n" % (name, len(data))).encode() + data
+
+
+class IMAPStandInServer(socketserver.ThreadingTCPServer):
+    """
+    IMAP server serving a mail store, see synthetic_folders and load_maildir
+
+    Options: latency (seconds per command), bandwidth (bytes per second),
+    drop_after (messages fetched per connection before dropping it),
+    max_drops (how many connections to drop in total, 0 for no limit)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, username = "user", password = "password", address = ("127.0.0.1", 0), capabilities = None, **options):
+        self.store = store
+        self.username = username
+        self.password = password
+        self.options = options
+        self.capabilities = capabilities or ["IMAP4rev1", "UIDPLUS", "ENABLE", "UTF8=ACCEPT", "COMPRESS=DEFLATE", "LIST-STATUS", "CONDSTORE", "QRESYNC"]
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.drops = 0
+        socketserver.ThreadingTCPServer.__init__(self, address, IMAPStandInHandler)
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def drop(self):
+        """
+        Returns True if one more connection may be dropped
+        """
+        with self.lock:
+            max_drops = self.options.get("max_drops", 0)
+            if max_drops and self.drops >= max_drops:
+                return False
+            self.drops += 1
+            self.stats["drops"] = self.drops
+            return True
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def start_server(store, **kwargs):
+    """
+    Starts a stand-in server in a background thread and returns it
+    """
+    server = IMAPStandInServer(store, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
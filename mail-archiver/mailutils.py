@@ -1,32 +1,181 @@
-from email.header import decode_header
 from email.utils import parsedate
-from email.parser import Parser
+from email.parser import BytesHeaderParser
 from email.policy import default
 import imaplib
-import mailbox
 import re
 import sys
+import queue
+import threading
 import time
-from tinydb import TinyDB, Query
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 
-from .utils import normalize, slugify_safe, detect_encoding
+from .database import MessageIndex
+from .filters import account_filters, compile_filters, excluded
+from .storage import open_store, parse_headers
+from .utils import account_id, humansize, message_metadata, normalize, slugify_safe
+
+
+server_slots_lock = threading.Lock()
+server_slots_registry = {}
+server_limits = {}
+
+traffic_lock = threading.Lock()
+traffic_registry = {}
 
 def extract_date(email):
     date = email.get('Date')
     return parsedate(date)
 
-def imap_connect( IMAP_SERVER, IMAP_USERNAME, IMAP_PASSWORD, IMAP_SSL):
+# imaplib does not know about RFC 4978
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class Traffic:
+    """
+    Bytes exchanged over compressed connections, on the wire and decompressed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wire = 0
+        self.plain = 0
+
+    def add(self, wire, plain):
+        with self.lock:
+            self.wire += wire
+            self.plain += plain
+
+    def summary(self):
+        if not self.wire:
+            return "IMAP traffic: compression not in use"
+
+        return "IMAP traffic: %s on the wire, %s decompressed (%.1fx)" % (humansize(self.wire), humansize(self.plain), self.plain / self.wire)
+
+class DeflateStream:
+    """
+    Stands in for the socket file of an imaplib connection once COMPRESS=DEFLATE
+    is active: raw deflate (RFC 1951) in both directions
+    """
+
+    def __init__(self, sock, traffic):
+        self.sock = sock
+        self.traffic = traffic
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = bytearray()
+
+    def send(self, data):
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(compressed)
+        self.traffic.add(len(compressed), len(data))
+
+    def fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            return False
+
+        plain = self.decompressor.decompress(chunk)
+        self.traffic.add(len(chunk), len(plain))
+        self.buffer += plain
+        return True
+
+    def read(self, size):
+        while len(self.buffer) < size and self.fill():
+            pass
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, limit = -1):
+        start = 0
+        while True:
+            pos = self.buffer.find(b"\n", start)
+            if pos >= 0 or (limit > 0 and len(self.buffer) >= limit):
+                break
+            start = len(self.buffer)
+            if not self.fill():
+                break
+
+        end = pos + 1 if pos >= 0 else len(self.buffer)
+        if limit > 0:
+            end = min(end, limit)
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+    def close(self):
+        pass
+
+def refresh_capabilities(connection):
+    """
+    Reads the capabilities again, they often grow once logged in
+    """
+    try:
+        typ, data = connection.capability()
+    except imaplib.IMAP4.error:
+        return connection.capabilities
+
+    if typ == 'OK' and data and data[-1]:
+        connection.capabilities = tuple(data[-1].decode().upper().split())
+
+    return connection.capabilities
+
+def imap_compress(connection, traffic):
+    """
+    Turns on COMPRESS=DEFLATE (RFC 4978) when the server advertises it
+    """
+    if 'COMPRESS=DEFLATE' not in connection.capabilities:
+        return False
+
+    typ, data = connection._simple_command('COMPRESS', 'DEFLATE')
+    if typ != 'OK':
+        return False
+
+    stream = DeflateStream(connection.sock, traffic)
+    connection.file = stream
+    connection.send = stream.send
+    return True
+
+def imap_connect( IMAP_SERVER, IMAP_USERNAME, IMAP_PASSWORD, IMAP_SSL, compress = True, traffic = None, port = None, qresync = False):
     """
     Connect to remote server
     """
     if IMAP_SSL is True:
-        connection = imaplib.IMAP4_SSL(IMAP_SERVER)
+        connection = imaplib.IMAP4_SSL(IMAP_SERVER, port or imaplib.IMAP4_SSL_PORT)
     else:
-        connection = imaplib.IMAP4(IMAP_SERVER)
+        connection = imaplib.IMAP4(IMAP_SERVER, port or imaplib.IMAP4_PORT)
     if IMAP_SSL == 'starttls':
-        mail.starttls()
+        connection.starttls()
     connection.login(IMAP_USERNAME, IMAP_PASSWORD)
+    refresh_capabilities(connection)
+
+    if compress:
+        try:
+            imap_compress(connection, traffic or Traffic())
+        except imaplib.IMAP4.error as e:
+            print("Unable to turn on compression: %s" % e)
+
+    # ENABLE is only allowed before a folder is selected
+    connection.qresync_enabled = False
+    connection.condstore_enabled = False
+    if qresync and 'QRESYNC' in connection.capabilities:
+        try:
+            typ, data = connection.enable("QRESYNC")
+            connection.qresync_enabled = connection.condstore_enabled = typ == 'OK'
+        except imaplib.IMAP4.error as e:
+            print("Unable to enable QRESYNC: %s" % e)
+    elif qresync and 'CONDSTORE' in connection.capabilities:
+        try:
+            typ, data = connection.enable("CONDSTORE")
+            connection.condstore_enabled = typ == 'OK'
+        except imaplib.IMAP4.error as e:
+            print("Unable to enable CONDSTORE: %s" % e)
+        if connection.condstore_enabled:
+            print("Server does not support QRESYNC, only flag changes are synced")
+    elif qresync:
+        print("Server does not support QRESYNC, flag changes and expunges are not synced")
 
     try:
         connection.enable("UTF8=ACCEPT")
@@ -43,7 +192,7 @@ def get_mail_folders(settings, connection = None, mail_folders = None):
     if not mail_folders is None:
         return mail_folders
 
-    if not mail:
+    if not connection:
         return mail_folders
 
     mail_folders = {}
@@ -119,83 +268,817 @@ def get_all_folders(connection):
 
     return folder_list, folder_separator
 
+STATUS_ITEMS = ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY')
+
+def parse_status_response(data):
+    """
+    Walks untagged STATUS responses and yields (folder, {item: value})
+    """
+    pos = 0
+    while pos < len(data):
+        item = data[pos]
+        pos += 1
+        if isinstance(item, tuple):
+            # Folder name sent as a literal, the items follow it
+            folder_id = item[1].decode()
+            rest = data[pos] if pos < len(data) and isinstance(data[pos], bytes) else b""
+            pos += 1
+        elif item:
+            found = re.match(rb'\s*("(?:[^"\\]|\\.)*"|[^\s(]+)\s*(\(.*\))', item)
+            if not found:
+                continue
+            folder_id = found.group(1).decode()
+            if folder_id.startswith('"'):
+                folder_id = re.sub(r'\\(.)', r'\1', folder_id[1:-1])
+            rest = found.group(2)
+        else:
+            continue
+
+        yield folder_id, {key.decode().lower(): int(value) for key, value in re.findall(rb"([A-Za-z-]+) (\d+)", rest)}
+
+def get_folder_status(connection, folder_ids, group_size = 50):
+    """
+    Returns {folder: {messages, uidnext, uidvalidity[, highestmodseq]}} with
+    as few round trips as the server allows
+
+    LIST-STATUS (RFC 5819) gets every folder in one command, otherwise STATUS
+    commands are pipelined, group_size of them in flight at once.
+    """
+    items = STATUS_ITEMS + (('HIGHESTMODSEQ',) if 'CONDSTORE' in connection.capabilities else ())
+    wanted = set(folder_ids)
+    statuses = {}
+    connection.untagged_responses.pop('STATUS', None)
+
+    if 'LIST-STATUS' in connection.capabilities:
+        try:
+            typ, data = connection._simple_command('LIST', '""', '"*"', 'RETURN', '(STATUS (%s))' % " ".join(items))
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            typ = 'NO'
+        connection.untagged_responses.pop('LIST', None)
+        typ, data = connection.response('STATUS')
+        statuses = {folder_id: status for folder_id, status in parse_status_response(data) if folder_id in wanted}
+
+    missing = [folder_id for folder_id in folder_ids if folder_id not in statuses]
+    for pos in range(0, len(missing), group_size):
+        tags = [
+            connection._command('STATUS', connection._quote(folder_id), '(%s)' % " ".join(items))
+            for folder_id in missing[pos:pos + group_size]
+        ]
+        for tag in tags:
+            try:
+                connection._command_complete('STATUS', tag)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                pass
+        typ, data = connection.response('STATUS')
+        statuses.update((folder_id, status) for folder_id, status in parse_status_response(data) if folder_id in wanted)
+
+    return statuses
 
-def saveToMaildir(msg, mail_folder, maildir_raw):
+def prescan_folders(settings, connection, db, folder_ids, stats = None):
     """
-    Saves a single email to local clone
+    Compares the STATUS of folders with the one stored after their last
+    complete sync, and returns {folder: status} of the folders to go over
+
+    Status is None for folders that could not be pre-scanned, those are
+    always synced.
     """
-    mbox = mailbox.Maildir(maildir_raw, factory=mailbox.MaildirMessage, create=True) 
-    folder = mbox.add_folder(mail_folder)
-    folder.lock()
+    if not settings.get('status_prescan', True) or not folder_ids:
+        return {folder_id: None for folder_id in folder_ids}
+
     try:
-        message_key = folder.add(msg)
-        folder.flush()
+        statuses = with_retries(settings, connection, stats or FetchStats(), 0, get_folder_status, connection, folder_ids)
+    except (imaplib.IMAP4.error, OSError) as e:
+        print("Unable to pre-scan folders: %s" % e)
+        return {folder_id: None for folder_id in folder_ids}
 
-        maildir_message = folder.get_message(message_key)
+    known = db.get_folder_statuses(account_id(settings))
+    changed = {}
+    for folder_id in folder_ids:
+        status = statuses.get(folder_id)
+        if status and known.get(folder_id) and all(known[folder_id].get(key) == value for key, value in status.items()):
+            continue
+        changed[folder_id] = status
+
+    print("Skipping %d unchanged folders, %d to sync" % (len(folder_ids) - len(changed), len(changed)))
+    return changed
+
+
+MAILDIR_FLAGS = {
+    b"\\Draft": "D",
+    b"\\Flagged": "F",
+    b"\\Answered": "R",
+    b"\\Seen": "S",
+    b"\\Deleted": "T",
+}
+
+def maildir_flags(envelope):
+    """
+    Translates the IMAP FLAGS of a FETCH response to Maildir info flags
+    """
+    found = re.search(rb"FLAGS \(([^)]*)\)", envelope or b"")
+    if not found:
+        return ""
+
+    return "".join(sorted(set(MAILDIR_FLAGS[flag] for flag in found.group(1).split() if flag in MAILDIR_FLAGS)))
+
+def open_writer(settings, mail_folder):
+    """
+    Returns the writer of a folder in the raw message store of the account
+    """
+    return open_store(settings).writer(mail_folder)
+
+def uid_set(uids):
+    """
+    Compacts a list of UIDs to an IMAP set, e.g. 1:200,205,210:215
+    """
+    uids = sorted(int(uid) for uid in uids)
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ",".join(str(low) if low == high else "%d:%d" % (low, high) for low, high in ranges)
+
+def expand_uid_set(value):
+    """
+    Expands an IMAP set of UIDs, e.g. 1:3,5, to a list of UIDs
+    """
+    uids = []
+    for part in value.split(","):
+        if ":" in part:
+            low, high = sorted(int(uid) for uid in part.split(":"))
+            uids.extend(range(low, high + 1))
+        elif part:
+            uids.append(int(part))
+
+    return uids
+
+def parse_fetch_response(data):
+    """
+    Walks a FETCH response and yields (uid, literal, envelope) for every
+    message in it, envelope being the non literal part of the response
+    """
+    pos = 0
+    while pos < len(data):
+        item = data[pos]
+        pos += 1
+        if not isinstance(item, tuple):
+            continue
+
+        envelope, literal = item
+        # Some servers send the UID or FLAGS after the literal
+        if pos < len(data) and isinstance(data[pos], bytes):
+            envelope += data[pos]
+        uid = re.search(rb"UID (\d+)", envelope)
+
+        yield (int(uid.group(1)) if uid else None), literal, envelope
+
+def fetch_messages(connection, uids, query, batch_size = 200):
+    """
+    Fetches messages with one UID FETCH per batch of UIDs and yields (uid, literal, envelope)
+    """
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        typ, data = connection.uid("FETCH", uid_set(batch), query)
+        if typ != "OK":
+            raise imaplib.IMAP4.error("FETCH failed for %s: %s" % (uid_set(batch), data))
+
+        for uid, literal, envelope in parse_fetch_response(data):
+            yield uid, literal, envelope
+
+def open_index(settings):
+    """
+    Opens the message index of an account, migrating a former db.json once
+    """
+    db = MessageIndex(settings['db'])
+    if settings.get('db_legacy'):
+        db.migrate_tinydb(settings['db_legacy'], account_id(settings))
+
+    return db
+
+class FetchStats:
+    """
+    Counts retried and failed messages over a whole run, shared among threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reconnects = 0
+        self.retried = 0
+        self.failed = []
+
+    def retry(self, count):
+        with self.lock:
+            self.reconnects += 1
+            self.retried += count
+
+    def fail(self, mail_folder, uid, reason):
+        with self.lock:
+            self.failed.append((mail_folder, uid, reason))
+
+    def summary(self):
+        lines = ["Reconnections: %d, retried messages: %d, failed messages: %d" % (self.reconnects, self.retried, len(self.failed))]
+        for mail_folder, uid, reason in self.failed[:20]:
+            lines.append("    > %s UID %s: %s" % (normalize(mail_folder, "utf7"), uid, reason))
+        if len(self.failed) > 20:
+            lines.append("    > ... and %d more" % (len(self.failed) - 20))
+
+        return "\n".join(lines)
+
+def reconnect(connection, settings):
+    """
+    Replaces, in place, a dropped connection by a freshly logged in one, so
+    that whoever holds the connection (e.g. the download pool) keeps using it
+    """
+    try:
+        connection.shutdown()
+    except Exception:
+        pass
+
+    fresh = connect_account(settings)
+    # Attributes of the dropped session must not outlive it, e.g. send()
+    # of a compressed stream when the fresh one is not compressed
+    connection.__dict__.clear()
+    connection.__dict__.update(fresh.__dict__)
+    connection.selected_folder = None
+
+def with_retries(settings, connection, stats, retried, task, *args):
+    """
+    Runs task(*args), reconnecting with exponential backoff when the connection
+    drops; retried is the number of messages requested again on every retry
+    """
+    max_retries = int(settings.get('max_retries', 5))
+    backoff = float(settings.get('retry_backoff', 1))
+    attempt = 0
+    while True:
         try:
-            message_date_epoch = time.mktime(parsedate(decode_header(maildir_message.get("Date"))[0][0]))
-        except TypeError as typeerror:
-            message_date_epoch = time.mktime((2000, 1, 1, 1, 1, 1, 1, 1, 0))
-        maildir_message.set_date(message_date_epoch)
-        maildir_message.add_flag("s")
+            return task(*args)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
 
-    finally:
-        folder.unlock()
-        folder.close()
-        mbox.close()
+            delay = backoff * 2 ** (attempt - 1)
+            print("Connection lost (%s), reconnecting in %.1fs (#%d)" % (e, delay, attempt))
+            time.sleep(delay)
+            stats.retry(retried)
+            try:
+                reconnect(connection, settings)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print("Reconnection failed: %s" % e)
 
-def get_message_to_local(mail_folder, connection, settings):
+def select_folder(mail_folder, connection, qresync = None):
     """
-    Goes over a folder and save all emails
+    Selects a folder (read only) unless the connection already has it selected
+
+    With qresync (uidvalidity, modseq) the server also reports the flag
+    changes and expunges since modseq, see sync_changes.
     """
-    maildir_raw = settings['maildir_raw']
-    db =  TinyDB(settings['db'])
-    print("Selecting folder %s" % normalize(mail_folder, "utf7"), end="")
-    connection.select(connection._quote(mail_folder), readonly=True)
-    print("..Done!")
+    if qresync:
+        # imaplib.select() cannot pass the QRESYNC parameter
+        connection.untagged_responses = {}
+        connection.is_readonly = True
+        typ, data = connection._simple_command('EXAMINE', connection._quote(mail_folder), '(QRESYNC (%d %d))' % qresync)
+        connection.state = 'SELECTED' if typ == 'OK' else 'AUTH'
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("Unable to select folder %s: %s" % (mail_folder, data))
+        connection.selected_folder = mail_folder
+    elif getattr(connection, 'selected_folder', None) != mail_folder:
+        typ, data = connection.select(connection._quote(mail_folder), readonly=True)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("Unable to select folder %s: %s" % (mail_folder, data))
+        connection.selected_folder = mail_folder
+
+def fetch_batch(mail_folder, connection, uids):
+    """
+    Fetches one batch of full messages, returns a list of (uid, literal, envelope)
+    """
+    select_folder(mail_folder, connection)
+    return list(fetch_messages(connection, uids, "(FLAGS RFC822)", len(uids)))
+
+# Headers and size needed for deduplication and the header side of filters
+HEADER_QUERY = "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT DATE FROM)])"
 
+def fetch_headers(mail_folder, connection, uids):
+    """
+    Fetches, without marking them as seen, the headers used to plan a download
+    """
+    select_folder(mail_folder, connection)
+    return list(fetch_messages(connection, uids, HEADER_QUERY, len(uids)))
+
+class MessageSelector:
+    """
+    Picks, out of fetched headers, the messages of a folder worth downloading:
+    not archived yet (by Message-ID) and not excluded by the rules left to
+    evaluate on headers, see filters.compile_filters
+
+    Archived messages left without UID by a change of UIDVALIDITY get their
+    new one.
+    """
+
+    def __init__(self, mail_folder, settings, db, rules = None):
+        self.mail_folder = mail_folder
+        self.account = account_id(settings)
+        self.db = db
+        self.rules = account_filters(settings) if rules is None else rules
+        self.to_download = {}
+        self.seen = set()
+        self.found = []
+        self.skipped = 0
+        self.filtered = 0
+
+    def add(self, uid, header_bytes, envelope = b""):
+        headers = BytesHeaderParser(policy=default).parsebytes(header_bytes)
+        message_id = headers['Message-ID']
+        if message_id:
+            message_id = str(message_id).strip()
+            if message_id in self.seen:
+                self.skipped += 1
+                return
+            if self.db.has_message(self.account, self.mail_folder, message_id):
+                self.found.append((message_id, int(uid)))
+                self.seen.add(message_id)
+                self.skipped += 1
+                return
+            self.seen.add(message_id)
+
+        size = re.search(rb"RFC822\.SIZE (\d+)", envelope or b"")
+        if self.rules and excluded(self.rules, headers, int(size.group(1)) if size else None):
+            self.filtered += 1
+            return
+
+        self.to_download[uid] = {'message_id': message_id, 'date': str(headers['Date'] or '')}
+
+    def done(self):
+        """
+        Returns {uid: {message_id, date}} of the messages to download
+        """
+        self.db.set_uids(self.account, self.mail_folder, self.found)
+        if self.skipped or self.filtered:
+            print("Skipping %d already archived and %d filtered messages in folder %s" % (self.skipped, self.filtered, normalize(self.mail_folder, "utf7")))
+
+        return self.to_download
+
+def select_messages_to_download(mail_folder, connection, settings, db, uid_list, stats = None, rules = None):
+    """
+    Fetches only the headers needed for deduplication and filtering, in large
+    batches, and returns {uid: {message_id, date}} of the messages worth
+    downloading
+    """
+    batch_size = int(settings.get('header_batch_size', 1000))
+    stats = stats or FetchStats()
+    selector = MessageSelector(mail_folder, settings, db, rules)
+    for pos in range(0, len(uid_list), batch_size):
+        batch = uid_list[pos:pos + batch_size]
+        for uid, header_bytes, envelope in with_retries(settings, connection, stats, 0, fetch_headers, mail_folder, connection, batch):
+            selector.add(uid, header_bytes, envelope)
+
+    return selector.done()
+
+def sync_changes(mail_folder, connection, settings, db):
+    """
+    Records in the index the flag changes (FETCH) and expunges (VANISHED)
+    reported by a QRESYNC select
+    """
+    typ, vanished = connection.response('VANISHED')
+    uids = []
+    for data in vanished:
+        if data:
+            uids.extend(expand_uid_set(data.decode().split()[-1]))
+
+    typ, fetched = connection.response('FETCH')
+    changes = []
+    for data in fetched:
+        uid = re.search(rb"UID (\d+)", data) if isinstance(data, bytes) else None
+        if uid:
+            changes.append((int(uid.group(1)), maildir_flags(data)))
+
+    account = account_id(settings)
+    db.mark_vanished(account, mail_folder, uids)
+    db.update_flags(account, mail_folder, changes)
+    if uids or changes:
+        print("Folder %s: %d messages vanished, %d changed flags" % (normalize(mail_folder, "utf7"), len(uids), len(changes)))
+
+def sync_flags(mail_folder, connection, settings, db, last_uid, modseq):
+    """
+    Records in the index the flag changes since modseq of the messages up
+    to last_uid, asked with CHANGEDSINCE (CONDSTORE without QRESYNC)
+    """
+    typ, fetched = connection.uid("FETCH", "1:%d" % last_uid, "(FLAGS)", "(CHANGEDSINCE %d)" % modseq)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error("FETCH CHANGEDSINCE failed: %s" % fetched)
+
+    changes = []
+    for data in fetched:
+        data = data[0] if isinstance(data, tuple) else data
+        uid = re.search(rb"UID (\d+)", data) if isinstance(data, bytes) else None
+        if uid:
+            changes.append((int(uid.group(1)), maildir_flags(data)))
+
+    db.update_flags(account_id(settings), mail_folder, changes)
+    if changes:
+        print("Folder %s: %d changed flags" % (normalize(mail_folder, "utf7"), len(changes)))
+
+def search_query(last_uid, criteria):
+    """
+    Returns the UID SEARCH query for the messages after last_uid matching criteria
+    """
+    keys = (["UID %d:*" % (last_uid + 1)] if last_uid else []) + list(criteria)
+
+    return " ".join(keys) or "ALL"
+
+def search_folder(mail_folder, connection, settings, db):
+    """
+    Selects a folder and returns {uidvalidity, last_uid, uids, rules,
+    highestmodseq, synced_modseq} of the uids to check, rules being the filters
+    left to evaluate on headers, or None when the folder cannot be read
+
+    In the qresync sync_mode, flag changes and expunges since the last sync
+    are recorded on the way, only flag changes when the server supports
+    CONDSTORE but not QRESYNC.
+    """
+    account = account_id(settings)
+    checkpoint = db.get_checkpoint(account, mail_folder)
+    qresync = settings.get('sync_mode', 'append') == 'qresync' and getattr(connection, 'qresync_enabled', False)
+    condstore = settings.get('sync_mode', 'append') == 'qresync' and getattr(connection, 'condstore_enabled', False)
+    synced_modseq = checkpoint['highestmodseq'] if condstore and checkpoint and checkpoint['highestmodseq'] else None
+
+    connection.selected_folder = None
     try:
-        typ, mdata = connection.search(None, "ALL")
+        select_folder(mail_folder, connection, (checkpoint['uidvalidity'], synced_modseq) if qresync and synced_modseq else None)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as imaperror:
+        print("Unable to select folder %s: %s" % (normalize(mail_folder, "utf7"), imaperror))
+        return None
+    print("Selecting folder %s..Done!" % normalize(mail_folder, "utf7"))
+
+    typ, data = connection.response('UIDVALIDITY')
+    uidvalidity = int(data[0]) if data and data[0] else None
+    typ, data = connection.response('HIGHESTMODSEQ')
+    highestmodseq = int(data[0]) if condstore and data and data[0] else None
+    last_uid = 0
+    if checkpoint and uidvalidity and checkpoint['uidvalidity'] == uidvalidity:
+        last_uid = checkpoint['last_uid']
+        if synced_modseq and qresync:
+            sync_changes(mail_folder, connection, settings, db)
+        elif synced_modseq and last_uid:
+            try:
+                sync_flags(mail_folder, connection, settings, db, last_uid, synced_modseq)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                print("Unable to sync the flags of folder %s: %s" % (normalize(mail_folder, "utf7"), e))
+    elif checkpoint:
+        synced_modseq = None
+        print("UIDVALIDITY of folder %s changed, doing a full resync" % normalize(mail_folder, "utf7"))
+        # Former UIDs now name other messages
+        db.forget_uids(account, mail_folder)
+
+    filters = account_filters(settings)
+    criteria, rules = compile_filters(filters)
+    try:
+        try:
+            typ, mdata = connection.uid("SEARCH", None, search_query(last_uid, criteria))
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            typ, mdata = 'NO', [str(e)]
+        if typ != 'OK' and criteria:
+            reason = mdata[-1].decode(errors="replace") if isinstance(mdata[-1], bytes) else mdata[-1]
+            print("Server refused the filters of folder %s (%s), evaluating them on headers" % (normalize(mail_folder, "utf7"), reason))
+            rules = filters
+            typ, mdata = connection.uid("SEARCH", None, search_query(last_uid, []))
+    except (imaplib.IMAP4.abort, OSError):
+        raise
     except Exception as imaperror:
         print("Error in IMAP Query: %s." % imaperror)
         print("Does the imap folder \"%s\" exists?" % mail_folder)
-        return
+        return None
+
+    return {
+        "uidvalidity": uidvalidity,
+        "last_uid": last_uid,
+        # "n:*" always matches the highest UID, even when it is lower than n
+        "uids": [uid for uid in mdata[0].decode().split() if int(uid) > last_uid],
+        "rules": rules,
+        "highestmodseq": highestmodseq,
+        "synced_modseq": synced_modseq,
+    }
+
+def plan_folder(mail_folder, connection, settings, db, stats = None, status = None):
+    """
+    Works out which messages of a folder have to be downloaded
+
+    Returns a plan {folder, uidvalidity, last_uid, to_download, status,
+    highestmodseq, synced_modseq} or None
+    """
+    stats = stats or FetchStats()
+    found = with_retries(settings, connection, stats, 0, search_folder, mail_folder, connection, settings, db)
+    if not found:
+        return None
+
+    uid_list = found["uids"]
+    to_download = select_messages_to_download(mail_folder, connection, settings, db, uid_list, stats, found["rules"])
+    print("Checked headers of folder %s (%d), %d to download" % (normalize(mail_folder, "utf7"), len(uid_list), len(to_download)))
+
+    return {
+        "folder": mail_folder,
+        "uidvalidity": found["uidvalidity"],
+        "last_uid": max([int(uid) for uid in uid_list] + [found["last_uid"]]),
+        "to_download": to_download,
+        "status": status,
+        "highestmodseq": found["highestmodseq"],
+        "synced_modseq": found["synced_modseq"],
+    }
+
+def download_messages(mail_folder, connection, settings, db, to_download, progress = True, stats = None, checkpoint = None):
+    """
+    Downloads full messages of a folder, see select_messages_to_download, and
+    saves them to Maildir, one batch at a time
 
-    message_list = mdata[0].decode().split()
+    A dropped connection is reopened and the current batch requested again.
+    Once a batch is on disk and indexed, checkpoint(last uid of the batch) is
+    called, as long as nothing failed so far.
+
+    Returns (downloaded, failed)
+    """
+    batch_size = int(settings.get('fetch_batch_size', 200))
+    stats = stats or FetchStats()
+
+    writer = open_writer(settings, mail_folder)
+    uids = sorted(to_download)
     sofar = 0
-    print("Copying folder %s (%s)" % (normalize(mail_folder, "utf7"), len(message_list)), end="")
-    Msg = Query()
-    for message_id in message_list:
-        result, data = connection.fetch(message_id , "(RFC822)")
-        raw_email = data[0][1].replace(b'\r\n', b'\n')
-        maildir_folder = mail_folder.replace("/", ".")
-        encoding = detect_encoding(raw_email)
+    failed = 0
+    for pos in range(0, len(uids), batch_size):
+        batch = uids[pos:pos + batch_size]
         try:
-            headers = Parser(policy=default).parsestr( raw_email.decode(encoding) )
-            # mmm = mailbox.MaildirMessage(message=raw_email)
-            message_id = headers['Message-ID']
-            # print(message_id)
-            find = db.search((Msg.message_id == message_id) & (Msg.mail_folder == mail_folder))
-            if len(find) == 0:
-                subject = headers['Subject']
-                if '* SPAM *' not in subject:
-                    print("To download")
-                    db.insert({'message_id': message_id, 'mail_folder': mail_folder})
-                    saveToMaildir(raw_econnection, maildir_folder, maildir_raw)
-                else:
-                    print("Subject contains spam")
-            else:
-                print("Already exists")
-                
-        except:
-            # print(raw_email)
-            pass
+            received = with_retries(settings, connection, stats, len(batch), fetch_batch, mail_folder, connection, batch)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            writer.flush()
+            for uid in uids[pos:]:
+                stats.fail(mail_folder, uid, "connection lost: %s" % e)
+            raise
+
+        saved, batch_failed = save_batch(mail_folder, settings, db, writer, to_download, batch, received, stats, progress, sofar)
+        sofar += saved + batch_failed
+        failed += batch_failed
+        if checkpoint and not failed:
+            checkpoint(batch[-1])
+
+    return sofar - failed, failed
+
+def save_batch(mail_folder, settings, db, writer, to_download, batch, received, stats, progress = False, sofar = 0):
+    """
+    Writes a fetched batch of messages, received as (uid, literal, envelope),
+    makes it durable and records it in the index, with the metadata of the
+    messages for build_struct
+
+    Returns (saved, failed)
+    """
+    account = account_id(settings)
+    archived = []
+    metadata = {}
+    failed = 0
+    for uid, raw_email, envelope in received:
+        raw_email = raw_email.replace(b'\r\n', b'\n')
+        message = to_download.get(uid, {})
+        try:
+            flags = maildir_flags(envelope)
+            key, digest = writer.add(raw_email, message.get('date'), flags)
+            archived.append((account, mail_folder, message.get('message_id'), uid, flags, digest, key))
+        except Exception as e:
+            failed += 1
+            stats.fail(mail_folder, uid, "unable to save: %s" % e)
+        else:
+            try:
+                if digest not in metadata:
+                    metadata[digest] = dict(message_metadata(parse_headers(raw_email)), size=len(raw_email))
+            except Exception:
+                # build_struct reads the message itself then
+                pass
         sofar += 1
 
+        if not progress:
+            continue
         if sofar % 10 == 0:
             print(sofar, end="")
         else:
             print('.', end="")
         sys.stdout.flush()
-    
-    print("..Done!")
+
+    # Expunged in the meantime, most likely
+    for uid in set(batch) - set(uid for uid, raw_email, envelope in received):
+        stats.fail(mail_folder, uid, "not returned by the server")
+
+    writer.flush()
+    db.add_metadata(account, list(metadata.items()))
+    db.add_messages(archived)
+
+    return len(archived), failed
+
+def finish_folder(db, settings, plan, last_uid = None):
+    """
+    Moves the checkpoint of a folder, by default past all the planned messages
+
+    Once the whole folder is done, its pre-scan status and HIGHESTMODSEQ are
+    stored as well.
+    """
+    highestmodseq = plan.get("synced_modseq")
+    if last_uid is None:
+        highestmodseq = plan.get("highestmodseq")
+        if plan.get("status"):
+            db.set_folder_status(account_id(settings), plan["folder"], plan["status"])
+
+    last_uid = last_uid or plan["last_uid"]
+    if plan["uidvalidity"] and last_uid:
+        db.set_checkpoint(account_id(settings), plan["folder"], plan["uidvalidity"], last_uid, highestmodseq)
+
+def get_message_to_local(mail_folder, connection, settings, db = None, stats = None, status = None):
+    """
+    Goes over a folder and save all emails
+    """
+    if db is None:
+        db = open_index(settings)
+    stats = stats or FetchStats()
+
+    plan = plan_folder(mail_folder, connection, settings, db, stats, status)
+    if plan is None:
+        return
+
+    started = time.time()
+    print("Copying folder %s (%s)" % (normalize(mail_folder, "utf7"), len(plan["to_download"])), end="")
+    sofar, failed = download_messages(
+        mail_folder, connection, settings, db, plan["to_download"],
+        stats=stats,
+        checkpoint=lambda uid: finish_folder(db, settings, plan, uid),
+    )
+    if not failed:
+        finish_folder(db, settings, plan)
+
+    elapsed = max(time.time() - started, 0.001)
+    print("..Done! %d messages in %.1fs (%.1f messages/s)" % (sofar, elapsed, sofar / elapsed))
+
+def account_traffic(settings):
+    """
+    Returns the traffic counter shared by all connections of an account
+    """
+    with traffic_lock:
+        return traffic_registry.setdefault(account_id(settings), Traffic())
+
+def connect_account(settings):
+    """
+    Opens a new authenticated connection for an account
+    """
+    return imap_connect(
+        settings.get('domain'),
+        settings.get('username'),
+        settings.get('password'),
+        settings.get('ssl', True),
+        compress=settings.get('compress', True),
+        traffic=account_traffic(settings),
+        port=settings.get('port'),
+        qresync=settings.get('sync_mode', 'append') == 'qresync',
+    )
+
+def server_key(settings):
+    """
+    Returns the (domain, port) an account connects to
+    """
+    port = settings.get('port') or (imaplib.IMAP4_SSL_PORT if settings.get('ssl', True) is True else imaplib.IMAP4_PORT)
+
+    return (settings.get('domain'), int(port))
+
+def set_server_limits(settings):
+    """
+    Registers the connection limits of many accounts before any of them
+    connects: accounts sharing a server share its slots, up to the smallest
+    max_connections_per_server configured among them
+    """
+    with server_slots_lock:
+        for setting in settings:
+            server = server_key(setting)
+            limit = int(setting.get('max_connections_per_server', 4))
+            server_limits[server] = min(limit, server_limits.get(server, limit))
+
+def server_slots(settings):
+    """
+    Returns the semaphore capping concurrent connections to the IMAP server
+    of an account, see set_server_limits
+    """
+    server = server_key(settings)
+    with server_slots_lock:
+        if server not in server_slots_registry:
+            limit = int(settings.get('max_connections_per_server', 4))
+            server_slots_registry[server] = threading.BoundedSemaphore(min(limit, server_limits.get(server, limit)))
+
+        return server_slots_registry[server]
+
+def download_folders(settings, connection, mail_folders, stats = None):
+    """
+    Archives selected folders concurrently over a pool of IMAP connections
+
+    Folders are first planned (header pre-fetch) one per worker, then their
+    downloads are split in chunks of fetch_batch_size so large folders are
+    shared among all workers.
+
+    The slot of the given connection is up to its opener, extra connections
+    are only opened while the server has slots left.
+    """
+    size = max(1, int(settings.get('connections', 1)))
+    size = min(size, int(settings.get('max_connections_per_server', 4)))
+    batch_size = int(settings.get('fetch_batch_size', 200))
+    slots = server_slots(settings)
+    db = open_index(settings)
+    stats = stats or FetchStats()
+
+    pool = queue.Queue()
+    opened = []
+    pool.put(connection)
+    opened.append(0)
+    for count in range(1, size):
+        if not slots.acquire(blocking=False):
+            break
+        try:
+            pool.put(connect_account(settings))
+        except Exception as e:
+            slots.release()
+            print("Unable to open IMAP connection #%d: %s" % (count + 1, e))
+            break
+        opened.append(count)
+
+    def plan(folder_id):
+        worker_connection = pool.get()
+        try:
+            return plan_folder(folder_id, worker_connection, settings, db, stats, changed[folder_id])
+        finally:
+            pool.put(worker_connection)
+
+    def download(folder_id, to_download):
+        worker_connection = pool.get()
+        try:
+            return download_messages(folder_id, worker_connection, settings, db, to_download, progress=False, stats=stats)
+        finally:
+            pool.put(worker_connection)
+
+    started = time.time()
+    changed = prescan_folders(settings, connection, db, [folder_id for folder_id in mail_folders if mail_folders[folder_id]["selected"]], stats)
+    folders = list(changed)
+    print("Archiving %d folders over %d connections" % (len(folders), len(opened)))
+    total = 0
+    try:
+        with ThreadPoolExecutor(max_workers=len(opened)) as executor:
+            plans = {}
+            for folder_id, future in [(folder_id, executor.submit(plan, folder_id)) for folder_id in folders]:
+                try:
+                    plans[folder_id] = future.result()
+                except Exception as e:
+                    print("Error planning folder %s: %s" % (normalize(folder_id, "utf7"), e))
+
+            chunks = {}
+            for folder_id, folder_plan in plans.items():
+                if not folder_plan:
+                    continue
+                uids = sorted(folder_plan["to_download"])
+                chunks[folder_id] = [
+                    (uids[pos:pos + batch_size][-1], executor.submit(download, folder_id, {uid: folder_plan["to_download"][uid] for uid in uids[pos:pos + batch_size]}))
+                    for pos in range(0, len(uids), batch_size)
+                ]
+
+            # Chunks are collected in UID order, so the checkpoint only moves
+            # past a chunk when all chunks before it made it to disk
+            for folder_id, futures in chunks.items():
+                failed = False
+                count = 0
+                for last_uid, future in futures:
+                    try:
+                        downloaded, chunk_failed = future.result()
+                        count += downloaded
+                        failed = failed or chunk_failed > 0
+                    except Exception as e:
+                        failed = True
+                        print("Error downloading from folder %s: %s" % (normalize(folder_id, "utf7"), e))
+                    if not failed:
+                        finish_folder(db, settings, plans[folder_id], last_uid)
+                total += count
+                if not failed:
+                    finish_folder(db, settings, plans[folder_id])
+                print("Done with folder: %s (%d messages)." % (normalize(folder_id, "utf7"), count))
+    finally:
+        while not pool.empty():
+            worker_connection = pool.get()
+            if worker_connection is not connection:
+                try:
+                    worker_connection.logout()
+                except Exception:
+                    pass
+                slots.release()
+
+    elapsed = max(time.time() - started, 0.001)
+    print("Archived %d messages in %.1fs (%.1f messages/s)" % (total, elapsed, total / elapsed))
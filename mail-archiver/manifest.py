@@ -0,0 +1,196 @@
+"""
+Incremental HTML builds
+
+Every page records a fingerprint of its inputs in manifest.json, next to the
+pages: the stored message, its metadata and thread, the folder tree shown in
+every side menu and the templates the page is made of. A build only renders
+pages whose fingerprint changed or whose file is missing, and removes those of
+the previous build it did not produce.
+"""
+import glob
+import hashlib
+import json
+import os
+
+
+MANIFEST = "manifest.json"
+
+# Templates every kind of page is rendered with
+PAGE_TEMPLATES = {
+    'mail': ("html.tpl", "nav-ul.tpl", "header-main.tpl", "page-mail.tpl", "folder-breadcrumbs.tpl"),
+    'folder': ("html.tpl", "nav-ul.tpl", "header-main.tpl", "page-mail-list.tpl"),
+}
+
+# Settings that show in pages
+PAGE_SETTINGS = ('username', 'domain', 'assets_location', 'prettify')
+
+# Fields of the folder index entry of a message, kept for unchanged pages
+ENTRY_FIELDS = ('id', 'from', 'to', 'subject', 'date', 'size', 'file', 'link', 'attachments', 'error_decoding', 'folders')
+
+# Template of the threads shown on the pages of messages replying or replied to
+THREAD_TEMPLATE = "thread-ul.tpl"
+
+
+def fingerprint(*parts):
+    """
+    Returns a short hash of JSON serializable parts
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def index_entry(entry):
+    """
+    Returns the part of the folder index entry of a message that is kept
+    """
+    return {field: entry.get(field) for field in ENTRY_FIELDS}
+
+def template_hashes(settings):
+    """
+    Returns {template name: hash of its source}
+    """
+    hashes = {}
+    for name in sorted(os.listdir(settings['templates_location'])):
+        with open(os.path.join(settings['templates_location'], name), "rb") as f:
+            hashes[name] = hashlib.sha1(f.read()).hexdigest()
+
+    return hashes
+
+def directory_fingerprint(path):
+    """
+    Returns a hash of the names, sizes and modification times of the files
+    under path
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            stat = os.stat(os.path.join(root, name))
+            files.append((os.path.relpath(os.path.join(root, name), path), stat.st_size, int(stat.st_mtime)))
+
+    return fingerprint(files)
+
+def page_base(settings, mailfolders, kind, templates):
+    """
+    Returns the fingerprint of what all the pages of a kind share: the folder
+    tree, the settings they show and their templates
+    """
+    tree = [(folder_id, folder.get("title"), folder.get("link"), folder.get("file"), folder.get("parent"), folder.get("selected")) for folder_id, folder in mailfolders.items()]
+
+    return fingerprint(
+        tree,
+        [settings.get(name) for name in PAGE_SETTINGS],
+        [(name, templates.get(name)) for name in PAGE_TEMPLATES[kind]],
+    )
+
+def set_fingerprints(struct, base, templates):
+    """
+    Sets the fingerprint of the page of every message of struct: what all
+    message pages share (base), the stored message, its metadata, folders and
+    every message of its thread, see threads.set_threads, and when its thread
+    is shown, the THREAD_TEMPLATE of templates
+    """
+    members = {}
+    for mail_id, record in struct.items():
+        members.setdefault(record.get("thread"), []).append((mail_id, record.get("parent"), record.get("subject"), record.get("date"), record.get("link"), record.get("children")))
+    threads = {
+        root: fingerprint(sorted(thread, key=str), templates.get(THREAD_TEMPLATE) if len(thread) > 1 else None)
+        for root, thread in members.items()
+    }
+
+    for mail_id, record in struct.items():
+        if not "source" in record:
+            continue
+        record["fingerprint"] = fingerprint(
+            base,
+            record.get("digest"),
+            [record.get(field) for field in ("subject", "from", "to", "date", "file", "parent")],
+            record.get("folders"),
+            threads[record.get("thread")],
+        )
+
+
+class BuildManifest:
+    """
+    Fingerprints of the pages of the previous build, and those of the
+    current one, saved by save()
+    """
+
+    def __init__(self, settings):
+        self.maildir_result = settings['maildir_result']
+        self.path = os.path.join(self.maildir_result, MANIFEST)
+        self.previous = {'pages': {}, 'outputs': {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.previous = json.load(f)
+            except ValueError:
+                # Torn by a crash, everything is rendered again
+                pass
+        self.templates = template_hashes(settings)
+        self.bases = {}
+        self.pages = {}
+        self.outputs = {}
+        self.reused = 0
+        self.removed = 0
+
+    def base(self, settings, mailfolders, kind):
+        """
+        Returns page_base of a kind of page, computed once per build
+        """
+        if kind not in self.bases:
+            self.bases[kind] = page_base(settings, mailfolders, kind, self.templates)
+
+        return self.bases[kind]
+
+    def reuse(self, file, fingerprint):
+        """
+        Returns the folder index entry of an unchanged message page, None if it
+        has to be rendered
+        """
+        page = self.previous.get('pages', {}).get(file)
+        if not page or page['fingerprint'] != fingerprint or not os.path.exists(os.path.join(self.maildir_result, file)):
+            return None
+
+        self.pages[file] = page
+        self.reused += 1
+        return page['entry']
+
+    def add(self, file, fingerprint, entry):
+        self.pages[file] = {'fingerprint': fingerprint, 'entry': entry}
+
+    def unchanged(self, output, fingerprint):
+        """
+        Tells whether an output other than a message page (folder index,
+        assets), relative to the HTML directory, is up to date, recording its
+        new fingerprint
+        """
+        self.outputs[output] = fingerprint
+
+        return self.previous.get('outputs', {}).get(output) == fingerprint and os.path.exists(os.path.join(self.maildir_result, output))
+
+    def prune(self):
+        """
+        Removes the message pages, with their attachments, and the folder
+        indexes of the previous build this one did not produce
+        """
+        for file in self.previous.get('pages', {}):
+            if file in self.pages:
+                continue
+            path = os.path.join(self.maildir_result, file)
+            # Attachments are saved next to the page, see templating.render_mail
+            attachments = glob.glob("%s-*" % glob.escape(path[:-len(".html")])) if path.endswith(".html") else []
+            for stale in [path] + attachments:
+                if os.path.isfile(stale):
+                    os.remove(stale)
+            self.removed += 1
+
+        for output in self.previous.get('outputs', {}):
+            path = os.path.join(self.maildir_result, output)
+            if output not in self.outputs and not os.path.isabs(output) and os.path.isfile(path):
+                os.remove(path)
+
+    def save(self):
+        self.prune()
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'pages': self.pages, 'outputs': self.outputs}, f)
+        os.replace(tmp_path, self.path)
@@ -2,10 +2,16 @@ import os
 import click
 import yaml
 import getpass
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # from .utils import normalize, remove_dir, copyDir, humansize, simplify_emailheaders, slugify_safe, strftime
 from .mailutils import *
+from .storage import close_store, open_store, remove_vanished
 from .templating import build_templates
+from .utils import account_id, humansize
+from . import aiofetch
 
 def welcomeBanner():
     click.echo(click.style("### Welcome to Mail Archiver ###", fg='blue'))
@@ -24,7 +30,10 @@ def prepare_dirs(settings):
     settings['maildir_result'] = "%s/html" % settings['maildir']
     if not os.path.exists(settings['maildir_result']):
         os.mkdir(settings['maildir_result'])
-    settings['db'] = "%s/db.json" % settings['maildir']
+    settings['objects'] = "%s/objects" % settings['maildir']
+    settings['packs'] = "%s/packs" % settings['maildir']
+    settings['db'] = "%s/index.sqlite" % settings['maildir']
+    settings['db_legacy'] = "%s/db.json" % settings['maildir']
 
     return settings
 
@@ -48,61 +57,163 @@ def print_mailfolders(allFolders, currentParent = '', intend = '  '):
         print_mailfolders(allFolders, folder_id, intend + "    ")
 
 def walk_mailfolders(settings, connection, mailfolders):
-    db = TinyDB('db.json')   
-    for folder_id in mailfolders:
-        if not mailfolders[folder_id]["selected"]:
-            continue
+    stats = FetchStats()
+    if settings.get('engine', 'imaplib') == 'asyncio':
+        db = open_index(settings)
+        changed = prescan_folders(settings, connection, db, [folder_id for folder_id in mailfolders if mailfolders[folder_id]["selected"]], stats)
+        # Its server slot goes to the first asyncio connection
+        connection.logout()
+        aiofetch.download_folders(settings, changed, stats)
+        print(stats.summary())
+        return stats
+
+    if int(settings.get('connections', 1)) > 1:
+        download_folders(settings, connection, mailfolders, stats)
+        print(stats.summary())
+        print(account_traffic(settings).summary())
+        return stats
 
+    db = open_index(settings)
+    changed = prescan_folders(settings, connection, db, [folder_id for folder_id in mailfolders if mailfolders[folder_id]["selected"]], stats)
+    for folder_id in changed:
         print(("Getting messages from server from folder: %s.") % normalize(folder_id, "utf7"))
-        get_message_to_local(folder_id, connection, settings)
-
-        # retries = 0
-        # try:
-        # except imaplib.IMAP4_SSL.abort:
-        #     if retries < 5:
-        #         print(("SSL Connection Abort. Trying again (#%i).") % retries)
-        #         retries += 1
-        #         mail = mailutils.imap_connect(settings.get('domain'), settings.get('username'), imap_password, settings.get('ssl', True))
-        #         mailutils.get_message_to_local(folder_id, connection, settings['maildir_raw'])
-        #     else:
-        #         print("SSL Connection gave more than 5 errors. Not trying again")
-
-
-        # if settings.get('ssl', True):
-        #     try:
-        #         mailutils.get_message_to_local(folder_id, connection, settings['maildir_raw'])
-        #     except imaplib.IMAP4_SSL.abort:
-        #         if retries < 5:
-        #             print(("SSL Connection Abort. Trying again (#%i).") % retries)
-        #             retries += 1
-        #             mail = mailutils.imap_connect(settings.get('domain'), settings.get('username'), imap_password, settings.get('ssl', True))
-        #             mailutils.get_message_to_local(folder_id, connection, settings['maildir_raw'])
-        #         else:
-        #             print("SSL Connection gave more than 5 errors. Not trying again")
-        # else:
-        #     try:
-        #         mailutils.get_message_to_local(folder_id, connection, settings['maildir_raw'])
-        #     except imaplib.IMAP4.abort:
-        #         if retries < 5:
-        #             print(("Connection Abort. Trying again (#%i).") % retries)
-        #             retries += 1
-        #             mail = mailutils.imap_connect(settings.get('domain'), settings.get('username'), imap_password)
-        #             mailutils.get_message_to_local(folder_id, connection, settings['maildir_raw'])
-        #         else:
-        #             print("Connection gave more than 5 errors. Not trying again")
+        try:
+            get_message_to_local(folder_id, connection, settings, db, stats, changed[folder_id])
+        except (imaplib.IMAP4.error, OSError) as e:
+            print("Giving up on folder %s: %s" % (normalize(folder_id, "utf7"), e))
+            continue
 
         print(("Done with folder: %s.") % normalize(folder_id, "utf7"))
 
+    print(stats.summary())
+    print(account_traffic(settings).summary())
+    return stats
+
+def download_account(setting):
+    """
+    Download phase of an account: connects, holding one slot of its IMAP
+    server, and walks its folders
+
+    Returns (mailfolders, stats)
+    """
+    slots = server_slots(setting)
+    with slots:
+        click.echo(click.style("Connecting to Server {}".format(setting.get('domain')), fg='blue'))
+        click.echo(click.style("IMAP Account {}".format(setting.get('username')), fg='blue'))
+        connection = connect_account(setting)
+        try:
+            mailfolders = get_mail_folders(setting, connection)
+            # print(mailfolders)
+            print_mailfolders(mailfolders)
+            click.echo(click.style("Start walking folders", fg='blue'))
+            stats = walk_mailfolders(setting, connection, mailfolders)
+        finally:
+            close_store(setting)
+            try:
+                connection.logout()
+            except Exception:
+                pass
+
+    return mailfolders, stats
+
+def render_account(setting, mailfolders):
+    """
+    Render phase of an account, returns how long it took
+    """
+    started = time.time()
+    click.echo(click.style("Start building templates for {}".format(account_id(setting)), fg='blue'))
+    build_templates(setting, mailfolders)
+
+    return time.time() - started
+
+def archive_accounts(settings, workers = 1, render_workers = 1):
+    """
+    Archives many accounts at once
+
+    Up to workers accounts download at the same time, each holding a slot of
+    its IMAP server, see mailutils.set_server_limits. As soon as an account is
+    downloaded, its pages are rendered in one of render_workers processes
+    while the other accounts keep downloading.
+
+    Returns a report {account: {download, render, failed, error}}
+    """
+    report = {account_id(setting): {'download': None, 'render': None, 'failed': 0, 'error': None} for setting in settings}
+    set_server_limits(settings)
+    render_pool = None
+    if render_workers > 0:
+        render_pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def archive_one(setting):
+        account = account_id(setting)
+        started = time.time()
+        try:
+            mailfolders, stats = download_account(setting)
+        except Exception as e:
+            report[account]['error'] = "download: %s" % e
+            return None
+        finally:
+            report[account]['download'] = time.time() - started
+        report[account]['failed'] = len(stats.failed)
+
+        if render_pool is None:
+            try:
+                report[account]['render'] = render_account(setting, mailfolders)
+            except Exception as e:
+                report[account]['error'] = "render: %s" % e
+            return None
+
+        return render_pool.submit(render_account, setting, mailfolders)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            downloads = [(account_id(setting), executor.submit(archive_one, setting)) for setting in settings]
+            renders = [(account, future.result()) for account, future in downloads]
+
+        for account, future in renders:
+            if future is None:
+                continue
+            try:
+                report[account]['render'] = future.result()
+            except Exception as e:
+                report[account]['error'] = "render: %s" % e
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
+
+    return report
+
+def print_report(report, elapsed):
+    """
+    Prints the consolidated timings of archive_accounts
+    """
+    click.echo(click.style("-" * 40, fg='blue'))
+    click.echo(click.style("%-40s %10s %10s %8s  %s" % ("Account", "Download", "Render", "Failed", "Status"), fg='blue'))
+    for account, timings in report.items():
+        click.echo("%-40s %10s %10s %8d  %s" % (
+            account,
+            "%.1fs" % timings['download'] if timings['download'] is not None else "-",
+            "%.1fs" % timings['render'] if timings['render'] is not None else "-",
+            timings['failed'],
+            timings['error'] or "ok",
+        ))
+    download = sum(timings['download'] or 0 for timings in report.values())
+    render = sum(timings['render'] or 0 for timings in report.values())
+    errors = len([timings for timings in report.values() if timings['error']])
+    click.echo(click.style("%d accounts (%d with errors) in %.1fs, %.1fs downloading and %.1fs rendering in total" % (len(report), errors, elapsed, download, render), fg='blue'))
+
 
 @click.command()
 @click.argument('config', type=click.File('rb'))
 @click.argument('output')
-def archive(config, output):
+@click.option('--workers', default=1, help='Accounts downloaded at the same time.')
+@click.option('--render-workers', default=1, help='Processes rendering downloaded accounts, 0 to render inline.')
+def archive(config, output, workers, render_workers):
     """Initialize config."""
     assets_location = "assets"
     templates_location = "templates"
     settings = yaml.safe_load(config)
     current_dir = os.path.dirname(os.path.realpath(__file__))
+    welcomeBanner()
     for setting in settings:
         setting['current_dir'] = current_dir
         setting['output'] = output
@@ -110,22 +221,39 @@ def archive(config, output):
         setting['templates_location'] = "{}/{}/".format(current_dir, templates_location)
         setting = prepare_dirs(setting)
 
-        welcomeBanner()
+        # Asked up front, accounts run concurrently afterwards
         imap_password = setting.get('password')
         if not imap_password:
             click.echo(click.style("Enter {} @ {} password".format(setting.get('username'), setting.get('domain')), fg='red'))
-            settings['password'] = getpass.getpass()
+            imap_password = getpass.getpass()
+            setting['password'] = imap_password
 
-        click.echo(click.style("Connecting to Server {}".format(setting.get('domain')), fg='blue'))
-        click.echo(click.style("IMAP Account {}".format(setting.get('username')), fg='blue'))
-        connection = imap_connect(setting.get('domain'), setting.get('username'), imap_password, setting.get('ssl', True))
-        mailfolders = get_mail_folders(setting, connection)
-        # print(mailfolders)
-        print_mailfolders(mailfolders)
-        click.echo(click.style("Start walking folders", fg='blue'))
-        walk_mailfolders(setting, connection, mailfolders)
-        click.echo(click.style("Start building templates", fg='blue'))
-        build_templates(setting, mailfolders)
+    started = time.time()
+    report = archive_accounts(settings, workers=workers, render_workers=render_workers)
+    print_report(report, time.time() - started)
+
+@click.command()
+@click.argument('config', type=click.File('rb'))
+@click.argument('output')
+@click.option('--drop-vanished', is_flag=True, help='Also remove from the archive the messages expunged from the server.')
+def compact(config, output, drop_vanished):
+    """Reclaim the space of messages no folder holds anymore."""
+    settings = yaml.safe_load(config)
+    welcomeBanner()
+    for setting in settings:
+        setting['output'] = output
+        setting = prepare_dirs(setting)
+        db = open_index(setting)
+        try:
+            store = open_store(setting)
+            if drop_vanished:
+                click.echo(click.style("{}: removing {} vanished messages".format(account_id(setting), remove_vanished(setting, db)), fg='blue'))
+                db.drop_vanished(account_id(setting))
+            kept, dropped, reclaimed = store.compact(db.get_digests(account_id(setting)))
+        finally:
+            close_store(setting)
+            db.close()
+        click.echo(click.style("{}: kept {} messages, dropped {}, reclaimed {}".format(account_id(setting), kept, dropped, humansize(reclaimed)), fg='blue'))
 
 if __name__ == '__main__':
     archive()
\ No newline at end of file
@@ -0,0 +1,645 @@
+"""
+Raw message storage backends
+
+MaildirStore (the default) keeps one file per message in Maildir folders, with
+the content store of hard linked objects. PackStore appends compressed
+messages to large segment files, with an offset index for random access, for
+archives too big for one inode per message. Both offer the same interface:
+
+    writer(folder) -> writer with add(raw, date, flags) -> (key, sha256), flush(), close()
+    keys(folder), count(folder), has_folder(folder)
+    get_bytes(folder, key), get_message(folder, key), identity(folder, key)
+    get_headers(folder, key) -> headers only, read up to the first blank line
+    remove(folder, key) -> takes a message out of a folder
+    compact(live) -> (kept, dropped, bytes reclaimed)
+"""
+import ctypes
+import hashlib
+import itertools
+import lzma
+import mailbox
+import mmap
+import os
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
+from email.parser import BytesHeaderParser
+from email.utils import parsedate
+
+from .database import MessageIndex
+from .utils import account_id
+
+
+maildir_counter = itertools.count()
+
+# Separates the header block of a message from its body
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+stores_lock = threading.Lock()
+stores_registry = {}
+
+# syncfs(2), Linux only
+try:
+    libc_syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError, TypeError):
+    libc_syncfs = None
+
+
+def message_epoch(date):
+    """
+    Returns the epoch of a Date header, used as mtime of the Maildir file
+    """
+    try:
+        return time.mktime(parsedate(str(date)))
+    except (TypeError, ValueError, OverflowError):
+        return time.mktime((2000, 1, 1, 1, 1, 1, 1, 1, 0))
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_files(paths):
+    """
+    Makes files durable: with one syncfs per file system they are on where
+    available, with one fsync per file otherwise
+    """
+    filesystems = {}
+    for path in paths:
+        filesystems.setdefault(os.stat(path).st_dev, path)
+
+    for path in filesystems.values():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if libc_syncfs is None or libc_syncfs(fd) != 0:
+                break
+        finally:
+            os.close(fd)
+    else:
+        return
+
+    for path in paths:
+        fsync_path(path)
+
+def hard_links(directory, other):
+    """
+    Tells whether files of directory can be hard linked into other
+    """
+    os.makedirs(directory, exist_ok=True)
+    probe = os.path.join(directory, ".links.%d.%d" % (os.getpid(), next(maildir_counter)))
+    link = os.path.join(other, os.path.basename(probe))
+    open(probe, "xb").close()
+    try:
+        os.link(probe, link)
+        os.remove(link)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.remove(probe)
+
+def parse_headers(raw_email):
+    """
+    Parses the header block of a raw message only, whatever its body
+    """
+    end = HEADER_END.search(raw_email)
+
+    return BytesHeaderParser().parsebytes(raw_email[:end.end()] if end else raw_email)
+
+class MaildirWriter:
+    """
+    Writes messages into one Maildir folder, opened once for many messages
+
+    Messages land in tmp/ and are synced and moved to cur/ by flush(): with
+    one syncfs for the whole batch and one for the directories on Linux, one
+    fsync per message and per directory elsewhere.
+
+    Given an objects directory, every distinct message is stored once, as
+    objects/<sha256[:2]>/<sha256>, and the folder gets a hard link to it: a
+    message filed in several folders (Gmail labels) takes the space of one.
+    """
+
+    def __init__(self, maildir_raw, mail_folder, objects = None):
+        mbox = mailbox.Maildir(maildir_raw, factory=None, create=True)
+        self.path = mbox.add_folder(mail_folder)._path
+        self.objects = objects
+        self.hostname = socket.gethostname().replace("/", r"\057").replace(":", r"\072")
+        self.pending = []
+        self.pending_objects = {}
+
+    def add(self, raw_email, date = None, flags = ""):
+        """
+        Writes a message with its mtime set from its Date header, returns its
+        key and its sha256
+        """
+        digest = hashlib.sha256(raw_email).hexdigest()
+        epoch = message_epoch(date)
+        now = time.time()
+        key = "%d.M%dP%dQ%d.%s" % (now, (now % 1) * 1e6, os.getpid(), next(maildir_counter), self.hostname)
+        tmp_path = os.path.join(self.path, "tmp", key)
+
+        source = self.store_object(raw_email, digest, epoch) if self.objects else None
+        if source:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                # No hard links on this file system
+                source = None
+        if not source:
+            with open(tmp_path, "xb") as f:
+                f.write(raw_email)
+            os.utime(tmp_path, (epoch, epoch))
+
+        # Links share the inode of their object, which flush() syncs
+        self.pending.append((tmp_path, os.path.join(self.path, "cur", "%s:2,%s" % (key, flags)), source is None))
+
+        return key, digest
+
+    def store_object(self, raw_email, digest, epoch):
+        """
+        Returns the path of the object holding a message, writing it if new
+        """
+        if digest in self.pending_objects:
+            return self.pending_objects[digest][0]
+
+        object_path = os.path.join(self.objects, digest[:2], digest)
+        if os.path.exists(object_path):
+            return object_path
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = "%s.%d.%d.tmp" % (object_path, os.getpid(), next(maildir_counter))
+        with open(tmp_path, "xb") as f:
+            f.write(raw_email)
+        os.utime(tmp_path, (epoch, epoch))
+        self.pending_objects[digest] = (tmp_path, object_path)
+
+        return tmp_path
+
+    def flush(self):
+        """
+        Makes all pending messages durable and visible
+        """
+        if not self.pending and not self.pending_objects:
+            return
+
+        sync_files(
+            [tmp_path for tmp_path, object_path in self.pending_objects.values()] +
+            [tmp_path for tmp_path, cur_path, unsynced in self.pending if unsynced]
+        )
+
+        for tmp_path, object_path in self.pending_objects.values():
+            os.rename(tmp_path, object_path)
+        for tmp_path, cur_path, unsynced in self.pending:
+            os.rename(tmp_path, cur_path)
+
+        # The new directory entries, of objects and of cur/, all at once
+        sync_files(sorted(
+            set(os.path.dirname(object_path) for tmp_path, object_path in self.pending_objects.values()) |
+            set([os.path.join(self.path, "cur")])
+        ))
+
+        self.pending = []
+        self.pending_objects = {}
+
+    def close(self):
+        self.flush()
+
+
+class MaildirStore:
+    """
+    Raw messages as Maildir folders under settings['maildir_raw']
+    """
+
+    def __init__(self, settings):
+        self.maildir_raw = settings['maildir_raw']
+        self.objects_path = settings.get('objects')
+        self.objects = self.objects_path if settings.get('content_store', True) else None
+        self.maildir = mailbox.Maildir(self.maildir_raw, factory=None, create=True)
+        self.folders = {}
+        if self.objects and not hard_links(self.objects, self.maildir_raw):
+            # Objects would only double the space of the copies in folders
+            print("No hard links from %s to %s, content_store is turned off" % (self.objects, self.maildir_raw))
+            self.objects = None
+
+    def writer(self, folder_id):
+        return MaildirWriter(self.maildir_raw, folder_id.replace("/", "."), self.objects)
+
+    def folder(self, folder_id):
+        if folder_id not in self.folders:
+            try:
+                self.folders[folder_id] = self.maildir.get_folder(folder_id.replace("/", "."))
+            except mailbox.NoSuchMailboxError:
+                return None
+
+        return self.folders[folder_id]
+
+    def has_folder(self, folder_id):
+        return self.folder(folder_id) is not None
+
+    def keys(self, folder_id):
+        folder = self.folder(folder_id)
+        return list(folder.iterkeys()) if folder is not None else []
+
+    def count(self, folder_id):
+        folder = self.folder(folder_id)
+        return len(folder) if folder is not None else 0
+
+    def get_bytes(self, folder_id, key):
+        return self.folder(folder_id).get_bytes(key)
+
+    def get_message(self, folder_id, key):
+        return self.folder(folder_id).get_message(key)
+
+    def get_headers(self, folder_id, key):
+        folder = self.folder(folder_id)
+        lines = []
+        with open(os.path.join(folder._path, folder._lookup(key)), "rb") as f:
+            for line in f:
+                lines.append(line)
+                if line in (b"\n", b"\r\n"):
+                    break
+
+        return BytesHeaderParser().parsebytes(b"".join(lines))
+
+    def identity(self, folder_id, key):
+        """
+        Returns what identifies the stored content of a message, shared by all
+        the hard links to one object of the content store
+        """
+        folder = self.folder(folder_id)
+        try:
+            stat = os.stat(os.path.join(folder._path, folder._lookup(key)))
+        except (OSError, KeyError):
+            return None
+
+        return (stat.st_dev, stat.st_ino)
+
+    def remove(self, folder_id, key):
+        folder = self.folder(folder_id)
+        if folder is not None:
+            folder.discard(key)
+
+    def compact(self, live = None):
+        """
+        Removes the objects of the content store no folder links to anymore,
+        and given live sha256s, those of other messages
+        """
+        kept = dropped = reclaimed = 0
+        if not self.objects_path or not os.path.isdir(self.objects_path):
+            return kept, dropped, reclaimed
+
+        for root, dirs, files in os.walk(self.objects_path):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                if stat.st_nlink > 1 and (live is None or name in live):
+                    kept += 1
+                    continue
+                os.remove(path)
+                dropped += 1
+                # Space held by remaining links is freed along with them
+                if stat.st_nlink == 1:
+                    reclaimed += stat.st_size
+
+        return kept, dropped, reclaimed
+
+    def close(self):
+        pass
+
+
+# Record in a segment: magic, codec, sha256, length of the compressed message
+RECORD = struct.Struct("<4sB32sI")
+RECORD_MAGIC = b"MAPK"
+# Entry of the offset index: sha256, segment, offset of the compressed message, its length, codec
+ENTRY = struct.Struct("<32sIQIB")
+
+CODECS = {'zlib': 1, 'lzma': 2}
+COMPRESS = {1: lambda data: zlib.compress(data, 6), 2: lzma.compress}
+DECOMPRESS = {1: zlib.decompress, 2: lzma.decompress}
+# Output size of the steps of PackStore.get_headers
+HEADER_CHUNK = 16 * 1024
+
+
+class PackStore:
+    """
+    Raw messages appended, once per content, to compressed segment files
+    under settings['packs'], with storage: pack
+
+    index.idx holds one fixed size ENTRY per message, loaded at open time and
+    only opened for appending once a writer is asked for. Segments are read
+    through read only memory maps. Folder membership comes from the message
+    index (sha256 of every archived message).
+    """
+
+    def __init__(self, settings):
+        self.path = settings['packs']
+        self.segment_size = int(settings.get('pack_segment_size', 256 * 1024 * 1024))
+        self.codec = CODECS[settings.get('pack_compression', 'zlib')]
+        self.settings = settings
+        self.account = account_id(settings)
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.maps = {}
+        self.index = None
+        self.segment = None
+        self.db = None
+        os.makedirs(self.path, exist_ok=True)
+        self.load_index()
+
+    def segment_path(self, number):
+        return os.path.join(self.path, "%06d.pack" % number)
+
+    def load_index(self):
+        """
+        Loads the offset index, leaving out entries past the end of their
+        segment (torn by a crash)
+        """
+        self.entries = {}
+        sizes = {}
+        self.last = 0
+        self.valid = 0
+        index_path = os.path.join(self.path, "index.idx")
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % ENTRY.size]
+            for digest, number, offset, length, codec in ENTRY.iter_unpack(data):
+                if number not in sizes:
+                    sizes[number] = os.path.getsize(self.segment_path(number)) if os.path.exists(self.segment_path(number)) else 0
+                if offset + length > sizes[number]:
+                    break
+                self.entries[digest] = (number, offset, length, codec)
+                self.last = max(self.last, number)
+                self.valid += ENTRY.size
+
+        self.last = max(self.last, 1)
+
+    def open_index(self):
+        """
+        Opens the offset index for appending, once, cutting off the entries
+        load_index left out
+        """
+        with self.lock:
+            if self.index is None:
+                # Entries appended since open time are kept
+                self.load_index()
+                self.index = open(os.path.join(self.path, "index.idx"), "ab")
+                self.index.truncate(self.valid)
+
+    def open_segment(self, size):
+        """
+        Returns the segment file to append size more bytes to
+        """
+        if self.segment and self.segment.tell() + size > self.segment_size and self.segment.tell() > 0:
+            self.flush()
+            self.segment.close()
+            self.segment = None
+            self.last += 1
+        if not self.segment:
+            self.segment = open(self.segment_path(self.last), "ab")
+
+        return self.segment
+
+    def append(self, raw_email):
+        """
+        Stores a message unless already there, returns its sha256
+        """
+        digest = hashlib.sha256(raw_email).digest()
+        with self.lock:
+            if digest not in self.entries:
+                payload = COMPRESS[self.codec](raw_email)
+                segment = self.open_segment(RECORD.size + len(payload))
+                offset = segment.tell() + RECORD.size
+                segment.write(RECORD.pack(RECORD_MAGIC, self.codec, digest, len(payload)))
+                segment.write(payload)
+                self.index.write(ENTRY.pack(digest, self.last, offset, len(payload), self.codec))
+                self.entries[digest] = (self.last, offset, len(payload), self.codec)
+
+        return digest.hex()
+
+    def flush(self):
+        """
+        Makes appended messages durable, segment before index
+        """
+        with self.lock:
+            if self.segment:
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+            if self.index is not None:
+                self.index.flush()
+                os.fsync(self.index.fileno())
+
+    def writer(self, folder_id):
+        self.open_index()
+        return PackWriter(self)
+
+    def folder_digests(self, folder_id):
+        if self.db is None:
+            self.db = MessageIndex(self.settings['db'])
+
+        return [digest for digest in self.db.get_folder_digests(self.account, folder_id) if bytes.fromhex(digest) in self.entries]
+
+    def has_folder(self, folder_id):
+        return len(self.folder_digests(folder_id)) > 0
+
+    def keys(self, folder_id):
+        return self.folder_digests(folder_id)
+
+    def count(self, folder_id):
+        return len(self.folder_digests(folder_id))
+
+    def remove(self, folder_id, key):
+        # Folder membership lives in the message index
+        pass
+
+    def payload(self, key):
+        """
+        Returns (codec, compressed bytes) of a stored message
+        """
+        number, offset, length, codec = self.entries[bytes.fromhex(key)]
+        with self.lock:
+            mapped = self.maps.get(number)
+            if mapped is None or len(mapped) < offset + length:
+                if self.segment and number == self.last:
+                    self.segment.flush()
+                # The segment grew since it was mapped
+                if mapped is not None:
+                    mapped.close()
+                with open(self.segment_path(number), "rb") as f:
+                    mapped = self.maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            return codec, mapped[offset:offset + length]
+
+    def get_bytes(self, folder_id, key):
+        codec, payload = self.payload(key)
+
+        return DECOMPRESS[codec](payload)
+
+    def get_message(self, folder_id, key):
+        return mailbox.MaildirMessage(self.get_bytes(folder_id, key))
+
+    def get_headers(self, folder_id, key):
+        """
+        Decompresses a message HEADER_CHUNK bytes at a time, until the end of
+        its header block
+        """
+        codec, payload = self.payload(key)
+        decompressor = zlib.decompressobj() if codec == CODECS['zlib'] else lzma.LZMADecompressor()
+        data = b""
+        while True:
+            if codec == CODECS['zlib']:
+                data += decompressor.decompress(payload, HEADER_CHUNK)
+                payload = decompressor.unconsumed_tail
+                done = decompressor.eof or not payload
+            else:
+                data += decompressor.decompress(payload, HEADER_CHUNK)
+                payload = b""
+                done = decompressor.eof or decompressor.needs_input
+            if done or HEADER_END.search(data, max(0, len(data) - HEADER_CHUNK - 3)):
+                break
+
+        return parse_headers(data)
+
+    def identity(self, folder_id, key):
+        return key
+
+    def compact(self, live):
+        """
+        Rewrites the segments with the records of live sha256s only, without
+        decompressing them, then drops the former segments
+        """
+        live = set(bytes.fromhex(digest) for digest in live)
+        with self.lock:
+            self.flush()
+            if self.segment:
+                self.segment.close()
+                self.segment = None
+            kept = dropped = 0
+            before = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path) if name.endswith(".pack"))
+
+            entries = {}
+            number = self.last + 1
+            segment = open(self.segment_path(number), "ab")
+            index_path = os.path.join(self.path, "index.idx")
+            with open(index_path + ".compact", "wb") as index:
+                for digest, (old_number, offset, length, codec) in sorted(self.entries.items(), key=lambda item: item[1][:2]):
+                    if digest not in live:
+                        dropped += 1
+                        continue
+                    if segment.tell() > 0 and segment.tell() + RECORD.size + length > self.segment_size:
+                        segment.flush()
+                        os.fsync(segment.fileno())
+                        segment.close()
+                        number += 1
+                        segment = open(self.segment_path(number), "ab")
+                    with open(self.segment_path(old_number), "rb") as f:
+                        f.seek(offset)
+                        payload = f.read(length)
+                    segment.write(RECORD.pack(RECORD_MAGIC, codec, digest, length))
+                    entries[digest] = (number, segment.tell(), length, codec)
+                    segment.write(payload)
+                    index.write(ENTRY.pack(digest, number, entries[digest][1], length, codec))
+                    kept += 1
+                segment.flush()
+                os.fsync(segment.fileno())
+                segment.close()
+                index.flush()
+                os.fsync(index.fileno())
+
+            # The new index takes over atomically, former segments go afterwards
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+            os.replace(index_path + ".compact", index_path)
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+            referenced = set(entry[0] for entry in entries.values())
+            for name in os.listdir(self.path):
+                if name.endswith(".pack") and int(name.split(".")[0]) not in referenced:
+                    os.remove(os.path.join(self.path, name))
+            self.load_index()
+            after = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path) if name.endswith(".pack"))
+
+        return kept, dropped, before - after
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.segment:
+                self.segment.close()
+                self.segment = None
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class PackWriter:
+    """
+    Writer of a folder in a PackStore, folder membership is recorded by the
+    caller in the message index
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, raw_email, date = None, flags = ""):
+        digest = self.store.append(raw_email)
+        return digest, digest
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.flush()
+
+
+def store_key(settings):
+    storage = settings.get('storage', 'maildir')
+    if storage not in ('maildir', 'pack'):
+        raise ValueError("Unknown storage %s, use maildir or pack" % storage)
+
+    return storage, settings['packs'] if storage == 'pack' else settings['maildir_raw']
+
+def open_store(settings):
+    """
+    Returns the raw message store of an account, shared within the process
+    """
+    key = store_key(settings)
+    with stores_lock:
+        if key not in stores_registry:
+            stores_registry[key] = PackStore(settings) if key[0] == 'pack' else MaildirStore(settings)
+
+        return stores_registry[key]
+
+def close_store(settings):
+    """
+    Closes the raw message store of an account, if open
+    """
+    with stores_lock:
+        store = stores_registry.pop(store_key(settings), None)
+    if store is not None:
+        store.close()
+
+def remove_vanished(settings, db):
+    """
+    Takes the messages marked vanished in the message index out of their
+    folders in the store, returns how many
+    """
+    store = open_store(settings)
+    vanished = db.get_vanished(account_id(settings))
+    for folder_id, key in vanished:
+        store.remove(folder_id, key)
+
+    return len(vanished)
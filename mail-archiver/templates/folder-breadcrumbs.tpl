@@ -1,5 +1,5 @@
 <ul class="folder-breadcrump">
-    {% for folderTitle, folderLink in folderList %}
+    {% for folderTitle, folderLink in folders %}
         <li>
             {% if folderLink %}
                 <a href="{{ link_prefix }}{{ folderLink }}">{{ folderTitle }}</a>
@@ -1,26 +1,19 @@
 <ul>
-    {% for mail in mailToShow %}
+    {% for mail in mails recursive %}
         <li>
             {% if mail.link %}
-                {% if mail.selected %}
-                    <a href="{{link_prefix}}{{ mail.link }}" data-id="{{ mail.id }}">
-                        <strong>{{ mail.subject }}</strong>
-                    </a>
-                    ({{ mail.date|strftime }})
-                {% else %}
-                    <a href="{{link_prefix}}{{ mail.link }}" data-id="{{ mail.id }}">
-                        {{ mail.subject }}
-                    </a>
-                    ({{ mail.date|strftime }})
-                {% endif %}
+                <a href="{{link_prefix}}{{ mail.link }}" data-id="{{ mail.id|e }}">
+                    {{ mail.open }}{{ mail.subject|e }}{{ mail.close }}
+                </a>
+                ({{ mail.date|strftime }})
             {% else %}
-                <span data-id="{{ mail.id }}">
-                    {{ mail.subject }}
+                <span data-id="{{ mail.id|e }}">
+                    {{ mail.subject|e }}
                     ({{ mail.date|strftime }})
                 </span>
             {% endif %}
             {% if mail.children %}
-                {{ mail.children }}
+                <ul>{{ loop(mail.children) }}</ul>
             {% endif %}
         </li>
     {% endfor %}
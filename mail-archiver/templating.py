@@ -1,82 +1,63 @@
 import os, sys
 import time
 import datetime
-from jinja2 import Environment
-from .utils import normalize, remove_dir, copyDir, humansize, simplify_emailheaders, slugify_safe, strftime
-import email
-import mailbox
-from email.utils import parsedate
-import hashlib
+import threading
+from bs4 import BeautifulSoup
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from .database import MessageIndex
+from .manifest import BuildManifest, directory_fingerprint, fingerprint, index_entry, set_fingerprints
+from .storage import close_store, open_store
+from .threads import set_threads, thread_tree
+from .utils import account_id, message_file, message_metadata, normalize, remove_dir, copyDir, humansize, simplify_emailheaders, slugify_safe, strftime
 import base64
 import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-def render_thread(settings, mailfolders, struct = {}, thread_current_mail_id = '', currently_selected_mail_id = '', link_prefix = '.'):
-    """
-    Renders a thread of mails
-    """
-
-    if not thread_current_mail_id in struct:
-        return ""
+# State of a render pool process, see init_render_worker
+render_worker = {}
 
-    mails = []
+# Jinja environments by templates directory, see get_environment
+environments_lock = threading.Lock()
+environments = {}
 
-    parent_id = struct[thread_current_mail_id].get("parent")
-
-    # if there is no parent, assume no other siblings
-    if not parent_id or not parent_id in struct:
-        current = {
-            "id": thread_current_mail_id,
-            "link": struct[thread_current_mail_id].get("link"),
-            "date": struct[thread_current_mail_id].get("date"),
-            "subject": struct[thread_current_mail_id].get("subject", "(mail not found)"),
-            "selected": thread_current_mail_id == currently_selected_mail_id,
-        }
-
-        mails.append(current)
-    else:
-        for sibling_id in struct[parent_id].get("children", []):
-            if not sibling_id in struct:
-                current = {
-                    "id": thread_current_mail_id,
-                    "link": None,
-                    "date": None,
-                    "subject": "(mail not found)",
-                    "selected": sibling_id == currently_selected_mail_id,
-                }
-                mails.append(current)
-                continue
+# Markers around the subjects of rendered threads, see render_thread
+thread_marker_re = re.compile(r"\x00([oc]\d+)\x00")
 
-            current = {
-                "id": sibling_id,
-                "link": struct[sibling_id]["link"],
-                "date": struct[sibling_id]["date"],
-                "subject": struct[sibling_id]["subject"],
-                "selected": sibling_id == currently_selected_mail_id,
-            }
-
-            mails.append(current)
-
-    # For each sibling, go to first child and try to recurse
-    for pos in range(len(mails)):
-        # For some
-        if not mails[pos]["id"] in struct:
-            continue
+def render_thread(settings, mailfolders, struct, mail_id, link_prefix = '.'):
+    """
+    Renders the thread of a mail, with the mail itself selected
 
-        if not struct[ mails[pos]["id"] ][ "children" ]:
-            continue
+    Every thread is rendered once, with markers around the subjects of its
+    messages: a page only swaps its own markers for <strong>.
+    """
+    root = struct.get(mail_id, {}).get("root", mail_id)
+    if not root in struct:
+        return ""
 
-        mails[pos]["children"] = render_thread(
-            settings,
-            mailfolders,
-            struct=struct,
-            thread_current_mail_id=struct[ mails[pos]["id"] ][ "children" ][0],
-            currently_selected_mail_id=currently_selected_mail_id,
-            link_prefix=link_prefix,
-        )
+    if not "fragment" in struct[root]:
+        mails, positions = thread_tree(struct, root)
+        struct[root]["fragment"] = None
+        if len(positions) > 1:
+            pending = list(mails)
+            while pending:
+                node = pending.pop()
+                node["open"] = "\x00o%d\x00" % node["position"]
+                node["close"] = "\x00c%d\x00" % node["position"]
+                pending.extend(node["children"])
+            html = render_template(settings, mailfolders, "thread-ul.tpl", None, mails=mails, link_prefix=link_prefix)
+            struct[root]["fragment"] = (thread_marker_re.split(html), positions)
+
+    if not struct[root]["fragment"]:
+        return ""
 
-    mails.sort(key=lambda val: val["date"])
+    pieces, positions = struct[root]["fragment"]
+    selected = {
+        "o%d" % positions.get(mail_id, -1): "<strong>",
+        "c%d" % positions.get(mail_id, -1): "</strong>",
+    }
 
-    return render_template(settings, mailfolders, "thread-ul.tpl", None, mails=mails, link_prefix=link_prefix)
+    return "".join(piece if pos % 2 == 0 else selected.get(piece, "") for pos, piece in enumerate(pieces))
 
 def get_mail_content(mail):
     """
@@ -162,192 +143,200 @@ def get_mail_content(mail):
     return content_of_mail_text, content_of_mail_html, attachments
 
 
-def to_local(settings, mailfolders, struct, folder_id):
+def render_mail(settings, mailfolders, struct, folder_id, mail_id, store):
     """
-    Creates HTML files and folder index from a mailbox folder
-    """
-    # print(folder_id)
-    print("Processing folder: %s" % normalize(folder_id, "utf7"), end="")
+    Renders the page of a message and writes its attachments
 
-    maildir_raw = settings['maildir_raw']
-    maildir_result= settings['maildir_result']
-    mails = {}
+    Returns the entry of the message in folder indexes
+    """
+    maildir_result = settings['maildir_result']
+    metadata = struct[mail_id]
+    mail = store.get_message(*metadata["source"])
+    mail_subject = metadata["subject"]
+    mail_from = metadata["from"]
+    mail_to = metadata["to"]
+    mail_date = metadata["date"]
+    mail_id_hash = metadata["hash"]
+    mail_folder = os.path.dirname(metadata["file"])
+    mail_raw = ""
+    error_decoding = ""
 
-    local_maildir_folder = folder_id.replace("/", ".")
-    local_maildir = mailbox.Maildir(os.path.join(maildir_raw), factory=None, create=True)
     try:
-        maildir_folder = local_maildir.get_folder(local_maildir_folder)
-    except mailbox.NoSuchMailboxError as e:
-        render_page(
-            settings,
-            mailfolders,
-            "%s/%s" % (maildir_result, mailfolders[folder_id]["file"]),
-            header_title="Folder %s" % mailfolders[folder_id]["title"],
-            link_prefix=".",
-            selected_folder=folder_id,
-            content=render_template(
-                settings,
-                mailfolders,
-                "page-mail-list.tpl",
-                None,
-                mails=mails,
-                link_prefix=".",
-                selected_folder=folder_id
-            )
-        )
-
-        print("..Done!")
-        return
-
-    print("(%d)" % len(maildir_folder), end="")
-    sofar = 0
-    for mail in maildir_folder:
-        mail_id = mail.get('Message-Id')
-        if mail_id in mails:
-            continue
-
-        mail_subject = normalize(mail.get('Subject'), 'header')
-
-        if not mail_subject:
-            mail_subject = "(No Subject)"
+        mail_raw = normalize(mail.as_bytes())
+    except Exception as e:
+        error_decoding += "~> Error in mail.as_bytes(): %s" % str(e)
 
-        mail_from = normalize(mail.get('From'), 'header')
-        mail_to = normalize(mail.get('To'), 'header')
-        mail_date = email.utils.parsedate(normalize(mail.get('Date'), 'header'))
-        if not mail_date:
-            mail_date = (2000, 1, 1, 12, 0, 00, 0, 1, -1)
-
-        if mail_id:
-            mail_id_hash = hashlib.md5(mail_id.encode()).hexdigest()
-        else:
-            temp = "%s %s %s %s" % (mail_subject, mail_date, mail_from, mail_to)
-            mail_id = hashlib.md5(temp.encode()).hexdigest()
-            mail_id_hash = mail_id
+    try:
+        os.makedirs("%s/%s" % (maildir_result, mail_folder))
+    except:
+        pass
 
-        mail_folder = str(time.strftime("%Y/%m/%d", mail_date))
-        mail_raw = ""
-        error_decoding = ""
+    fileName = metadata["file"]
+    content_of_mail_text, content_of_mail_html, attachments = "", "", []
 
-        try:
-            mail_raw = normalize(mail.as_bytes())
-        except Exception as e:
-            error_decoding += "~> Error in mail.as_bytes(): %s" % str(e)
+    try:
+        content_of_mail_text, content_of_mail_html, attachments = get_mail_content(mail)
+    except Exception as e:
+        error_decoding += "~> Error in get_mail_content: %s" % str(e)
 
-        try:
-            os.makedirs("%s/%s" % (maildir_result, mail_folder))
-        except:
-            pass
+    data_uri_to_download = ''
+    try:
+        data_uri_to_download = "data:text/plain;base64,%s" % base64.b64encode(mail_raw.encode())
+    except Exception as e:
+        error_decoding += "~> Error in data_uri_to_download: %s" % str(e)
 
-        fileName = "%s/%s.html" % (mail_folder, mail_id_hash)
-        content_of_mail_text, content_of_mail_html, attachments = "", "", []
+    content_default = "raw"
+    if content_of_mail_text:
+        content_default = "text"
+    if content_of_mail_html:
+        content_default = "html"
 
+    attachment_count = 0
+    for attachment in attachments:
+        attachment_count += 1
+        attachment["path"] = "%s/%s-%02d-%s" % (mail_folder, mail_id_hash, attachment_count, attachment["slug"])
+        attachment["link"] = "%s/%s-%02d-%s" % (mail_folder, mail_id_hash, attachment_count, attachment["slug"])
         try:
-            content_of_mail_text, content_of_mail_html, attachments = get_mail_content(mail)
+            with open("%s/%s" % (maildir_result, attachment["path"]), 'wb') as att_file:
+                att_file.write(attachment["content"])
         except Exception as e:
-            error_decoding += "~> Error in get_mail_content: %s" % str(e)
+            error_decoding += "~> Error writing attachment: %s" % str(e)
+            print("Error writing attachment: " + str(e) + ".\n")
+
+    mailReplyTo = None
+    if metadata["parent"] and metadata["parent"] in struct:
+        mailReplyTo = struct[metadata["parent"]]
+
+    entry = {
+        "id": mail_id,
+        "from": mail_from,
+        "to": mail_to,
+        "subject": mail_subject,
+        "date": str(time.strftime("%Y-%m-%d %H:%m", mail_date)),
+        "size": len(mail_raw),
+        "file": fileName,
+        "link": metadata["link"],
+        "replyTo": mailReplyTo,
+        "content": {
+            "html": content_of_mail_html,
+            "text": content_of_mail_text,
+            "raw": mail_raw,
+            "default": content_default,
+        },
+        "download": {
+            "filename": "%s.eml" % mail_id_hash,
+            "content": data_uri_to_download,
+        },
+        "attachments": attachments,
+        "error_decoding": error_decoding,
+        "folders": struct[mail_id]["folders"],
+    }
 
-        data_uri_to_download = ''
-        try:
-            data_uri_to_download = "data:text/plain;base64,%s" % base64.b64encode(mail_raw.encode())
-        except Exception as e:
-            error_decoding += "~> Error in data_uri_to_download: %s" % str(e)
-
-        content_default = "raw"
-        if content_of_mail_text:
-            content_default = "text"
-        if content_of_mail_html:
-            content_default = "html"
-
-        attachment_count = 0
-        for attachment in attachments:
-            attachment_count += 1
-            attachment["path"] = "%s/%s-%02d-%s" % (mail_folder, mail_id_hash, attachment_count, attachment["slug"])
-            attachment["link"] = "%s/%s-%02d-%s" % (mail_folder, mail_id_hash, attachment_count, attachment["slug"])
-            try:
-                with open("%s/%s" % (maildir_result, attachment["path"]), 'wb') as att_file:
-                    att_file.write(attachment["content"])
-            except Exception as e:
-                error_decoding += "~> Error writing attachment: %s" % str(e)
-                print("Error writing attachment: " + str(e) + ".\n")
-
-        mailReplyTo = None
-        mailReplyToRaw = normalize(mail.get('In-Reply-To'), 'header')
-        if mailReplyToRaw and mailReplyToRaw in struct:
-            mailReplyTo = struct[mailReplyToRaw]
-
-        mails[mail_id] = {
-            "id": mail_id,
-            "from": mail_from,
-            "to": mail_to,
-            "subject": mail_subject,
-            "date": str(time.strftime("%Y-%m-%d %H:%m", mail_date)),
-            "size": len(mail_raw),
-            "file": fileName,
-            "link": "/%s" % fileName,
-            "replyTo": mailReplyTo,
-            "content": {
-                "html": content_of_mail_html,
-                "text": content_of_mail_text,
-                "raw": mail_raw,
-                "default": content_default,
-            },
-            "download": {
-                "filename": "%s.eml" % mail_id_hash,
-                "content": data_uri_to_download,
-            },
-            "attachments": attachments,
-            "error_decoding": error_decoding,
-            "folders": struct[mail_id]["folders"],
-        }
-
-        thread_parent = None
-        if struct.get(mail_id, {}).get("parent") or len(struct.get(mail_id, {}).get("children", [])) > 0:
-            thread_parent = mail_id
-            while struct.get(thread_parent, {}).get("parent"):
-                thread_parent = struct.get(thread_parent, {}).get("parent")
-
-        render_page(
+    render_page(
+        settings,
+        mailfolders,
+        "%s/%s" % (maildir_result, entry["file"]),
+        title="%s | %s" % (mail_subject, mailfolders[folder_id]["title"]),
+        header_title=entry["subject"],
+        link_prefix="../../..",
+        selected_folder=struct[mail_id]["folders"],
+        content=render_template(
             settings,
             mailfolders,
-            "%s/%s" % (maildir_result, mails[mail_id]["file"]),
-            title="%s | %s" % (mail_subject, mailfolders[folder_id]["title"]),
-            header_title=mails[mail_id]["subject"],
+            "page-mail.tpl",
+            None,
+            mail=entry,
             link_prefix="../../..",
             selected_folder=struct[mail_id]["folders"],
-            content=render_template(
-                settings,
-                mailfolders,
-                "page-mail.tpl",
-                None,
-                mail=mails[mail_id],
-                link_prefix="../../..",
-                selected_folder=struct[mail_id]["folders"],
-                thread=render_thread(
-                    settings,
-                    mailfolders,
-                    struct=struct,
-                    thread_current_mail_id=thread_parent,
-                    currently_selected_mail_id=mail_id,
-                    link_prefix="../../..",
-                ),
-            )
+            thread=render_thread(settings, mailfolders, struct, mail_id, link_prefix="../../.."),
         )
+    )
+
+    # No need to keep it in memory
+    entry["attachments"] = len(entry["attachments"])
+
+    return index_entry(entry)
+
+def init_render_worker(settings, mailfolders, struct):
+    """
+    Initializer of the processes of a render pool, receiving the folder tree
+    and thread structure once
+    """
+    render_worker.update(settings=settings, mailfolders=mailfolders, struct=struct)
+
+def render_chunk(args):
+    """
+    Renders the pages of a chunk of messages in a render pool process
+
+    Returns their entries in folder indexes
+    """
+    folder_id, mail_ids = args
+    settings = render_worker['settings']
+    store = open_store(settings)
+
+    return [render_mail(settings, render_worker['mailfolders'], render_worker['struct'], folder_id, mail_id, store) for mail_id in mail_ids]
+
+def to_local(settings, mailfolders, struct, folder_id, mail_ids, rendered = None, pool = None, manifest = None):
+    """
+    Creates HTML files and folder index from a mailbox folder
+
+    mail_ids are the messages of the folder, as listed by build_struct, whose
+    records provide their metadata. rendered maps message ids to the list
+    entries of the messages whose page was already rendered, from another
+    folder. Given a pool started with init_render_worker, pages are rendered
+    in chunks by its processes. Given a BuildManifest, only pages whose
+    fingerprint changed are rendered.
+    """
+    if rendered is None:
+        rendered = {}
+
+    # print(folder_id)
+    print("Processing folder: %s" % normalize(folder_id, "utf7"), end="")
 
-        # No need to keep it in memory
-        del mails[mail_id]["content"]
-        del mails[mail_id]["download"]
-        mails[mail_id]["attachments"] = len(mails[mail_id]["attachments"])
+    maildir_result= settings['maildir_result']
+    mails = {}
 
-        sofar += 1
-        if sofar % 10 == 0:
-            print(sofar, end="")
+    print("(%d)" % len(mail_ids), end="")
+    to_render = []
+    for mail_id in mail_ids:
+        if mail_id in rendered:
+            continue
+        entry = manifest.reuse(struct[mail_id]["file"], struct[mail_id].get("fingerprint")) if manifest else None
+        if entry is None:
+            to_render.append(mail_id)
         else:
-            print('.', end="")
+            rendered[mail_id] = entry
+    sofar = 0
+    if pool is None:
+        store = open_store(settings)
+        results = ([render_mail(settings, mailfolders, struct, folder_id, mail_id, store)] for mail_id in to_render)
+    else:
+        chunk_size = int(settings.get('render_chunk_size', 50))
+        results = pool.map(render_chunk, [(folder_id, to_render[pos:pos + chunk_size]) for pos in range(0, len(to_render), chunk_size)])
+
+    for entries in results:
+        for entry in entries:
+            rendered[entry["id"]] = entry
+            if manifest:
+                manifest.add(entry["file"], struct[entry["id"]].get("fingerprint"), entry)
+
+            sofar += 1
+            if sofar % 10 == 0:
+                print(sofar, end="")
+            else:
+                print('.', end="")
         sys.stdout.flush()
     print("Done!")
 
+    for mail_id in mail_ids:
+        mails[mail_id] = rendered[mail_id]
+
     print("    > Creating index file..", end="")
     sys.stdout.flush()
+    if manifest and manifest.unchanged(mailfolders[folder_id]["file"], fingerprint(manifest.base(settings, mailfolders, 'folder'), folder_id, list(mails.values()))):
+        print("Unchanged!")
+        return
+
     render_page(
         settings,
         mailfolders,
@@ -463,24 +452,36 @@ def get_title(settings, title = None):
 
     return ' | '.join(result)
 
+def get_environment(settings):
+    """
+    Returns the Jinja environment of a templates directory, created once per
+    process: templates are compiled once and kept by name, and with
+    template_cache_dir their bytecode is kept on disk for the next runs
+    """
+    key = (settings['templates_location'], settings.get('template_cache_dir'))
+    with environments_lock:
+        if not key in environments:
+            bytecode_cache = None
+            if settings.get('template_cache_dir'):
+                os.makedirs(settings['template_cache_dir'], exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(settings['template_cache_dir'])
+
+            env = Environment(loader=FileSystemLoader(settings['templates_location']), bytecode_cache=bytecode_cache)
+            env.filters["humansize"] = humansize
+            env.filters["simplify_emailheaders"] = simplify_emailheaders
+            env.filters["strftime"] = strftime
+            env.filters["render_breadcrumbs"] = render_breadcrumbs
+            environments[key] = env
+
+        return environments[key]
+
 def render_template(settings, mailfolders, template_name, save_to, **kwargs):
     """
     Helper function to render a templete with variables
     """
-    contents = ''
-    template_path = settings['templates_location'] + template_name
-    with open(template_path, "r") as f:
-        contents = f.read()
-
-    env = Environment()
-    
-    env.filters["humansize"] = humansize
-    env.filters["simplify_emailheaders"] = simplify_emailheaders
-    env.filters["strftime"] = strftime
-    env.filters["render_breadcrumbs"] = render_breadcrumbs
     kwargs['settings'] = settings
     kwargs['mailfolders'] = mailfolders
-    template = env.from_string(contents)
+    template = get_environment(settings).get_template(template_name)
     result = template.render(**kwargs)
     if save_to:
         with open(save_to, "w", encoding="utf-8") as f:
@@ -519,88 +520,138 @@ def render_page(settings, mailfolders, save_to, **kwargs):
 
     return render_template(settings, mailfolders, "html.tpl", save_to, **kwargs)
 
+def load_metadata(settings):
+    """
+    Returns (known, vanished): {folder: {key: (sha256, metadata)}} of the
+    messages whose metadata was recorded in the message index when they were
+    saved, in UID order, and {folder: keys} of those expunged from the server
+    """
+    known = {}
+    vanished = {}
+    if not settings.get('db') or not os.path.exists(settings['db']):
+        return known, vanished
+
+    db = MessageIndex(settings['db'])
+    try:
+        for folder_id, key, sha256, metadata in db.get_metadata(account_id(settings)):
+            known.setdefault(folder_id, {})[key] = (sha256, message_file(metadata))
+        for folder_id, key in db.get_vanished(account_id(settings)):
+            vanished.setdefault(folder_id, set()).add(key)
+    finally:
+        db.close()
+
+    return known, vanished
+
 def build_struct(settings, mailfolders):
+    """
+    Returns (struct, messages) of the stored messages
+
+    struct maps message ids to their metadata record (see message_metadata),
+    with the folders they are filed in and the (folder, key) to read them
+    from, for threads.set_threads to thread. messages maps folder ids to the
+    ids of their messages, in UID order.
+
+    Metadata comes from the message index in one query, only the headers of
+    messages it does not know (archived by former versions) are read. Messages
+    it marks vanished are left out.
+    """
     mailfiles = {}
+    messages = {}
+    # Hard links of one stored message are parsed once
+    identities = {}
+    store = open_store(settings)
+    known, vanished = load_metadata(settings)
+    parsed = 0
     for folder_id in mailfolders:
         if not mailfolders[folder_id]["selected"]:
             continue
 
-        local_maildir_folder = folder_id.replace("/", ".")
-        local_maildir = mailbox.Maildir(os.path.join(settings['maildir_raw']), factory=None, create=True)
-        try:
-            maildir_folder = local_maildir.get_folder(local_maildir_folder)
-        except mailbox.NoSuchMailboxError as e:
-            continue
-
-        for mail in maildir_folder:
-            mail_id = mail.get('Message-Id')
-            mail_subject = normalize(mail.get('Subject'), 'header')
-            mail_from = normalize(mail.get('From'), 'header')
-            mail_to = normalize(mail.get('To'), 'header')
-
-            if not mail_subject:
-                mail_subject = "(No Subject)"
-
-            mail_date = email.utils.parsedate(normalize(mail.get('Date'), 'header'))
-            if not mail_date:
-                mail_date = (2000, 1, 1, 12, 0, 00, 0, 1, -1)
-
-            if mail_id:
-                mail_id_hash = hashlib.md5(mail_id.encode()).hexdigest()
+        messages[folder_id] = []
+        folder_known = known.get(folder_id, {})
+        folder_vanished = vanished.get(folder_id, set())
+        stored = [key for key in store.keys(folder_id) if key not in folder_vanished]
+        stored_set = set(stored)
+        keys = [key for key in folder_known if key in stored_set] + [key for key in stored if key not in folder_known]
+        for key in keys:
+            if key in folder_known:
+                identity, metadata = folder_known[key]
             else:
-                temp = "%s %s %s %s" % (mail_subject, mail_date, mail_from, mail_to)
-                mail_id = hashlib.md5(temp.encode()).hexdigest()
-                mail_id_hash = mail_id
-
-            mail_folder = str(time.strftime("%Y/%m/%d", mail_date))
-            fileName = "%s/%s.html" % (mail_folder, mail_id_hash)
-
-            if not mail_id in mailfiles:
-                mailfiles[mail_id] = {}
+                identity, metadata = store.identity(folder_id, key), None
 
-            mailfiles[mail_id]["id"] = mail_id
-            mailfiles[mail_id]["date"] = mail_date
-            mailfiles[mail_id]["subject"] = mail_subject
-            mailfiles[mail_id]["file"] = fileName
-            mailfiles[mail_id]["link"] = "/%s" % fileName
+            if identity in identities:
+                mail_id = identities[identity]
+            else:
+                if metadata is None:
+                    metadata = message_metadata(store.get_headers(folder_id, key))
+                    parsed += 1
+                mail_id = metadata["id"]
+                if identity:
+                    identities[identity] = mail_id
 
-            if not mailfiles[mail_id].get("children"):
-                mailfiles[mail_id]["children"] = []
+                if not mail_id in mailfiles:
+                    mailfiles[mail_id] = {}
 
-            if not mailfiles[mail_id].get("folders"):
-                mailfiles[mail_id]["folders"] = []
+                mailfiles[mail_id].update(metadata)
+                mailfiles[mail_id]["digest"] = str(identity)
+                mailfiles[mail_id].setdefault("source", (folder_id, key))
+                mailfiles[mail_id].setdefault("folders", [])
 
             if not folder_id in mailfiles[mail_id]["folders"]:
                 mailfiles[mail_id]["folders"].append(folder_id)
-
-            if not mailfiles[mail_id].get("parent"):
-                mailfiles[mail_id]["parent"] = normalize(mail.get('In-Reply-To'), 'header')
-
-                if mailfiles[mail_id]["parent"]:
-                    if not mailfiles[mail_id]["parent"] in mailfiles:
-                        mailfiles[ mailfiles[mail_id]["parent"] ] = {
-                            "parent": "",
-                            "children": [],
-                        }
-
-                    if not mail_id in mailfiles[ mailfiles[mail_id]["parent"] ][ "children" ]:
-                        mailfiles[ mailfiles[mail_id]["parent"] ][ "children" ].append(mail_id)
+                messages[folder_id].append(mail_id)
 
         print(".", end="")
         sys.stdout.flush()
-    print("Done (%d) mails" % len(mailfiles))
-    return (mailfiles)
+    print("Done (%d) mails, %d read from the store" % (len(mailfiles), parsed))
+    return mailfiles, messages
 
 def build_templates(settings, mailfolders):
+    """
+    Renders the pages of an account, only those whose inputs changed since
+    the previous build unless incremental is off
+
+    Once the pages are rendered, the flag changes recorded in the message
+    index are acknowledged. Vanished messages stay in the store, marked, see
+    compact --drop-vanished.
+    """
+    manifest = BuildManifest(settings) if settings.get('incremental', True) else None
     render_index(settings, mailfolders)
-    remove_dir("{}/{}".format(settings['maildir_result'], settings['assets_location']) )
-    copyDir(settings['assets_location'], "{}/{}".format(settings['maildir_result'],settings['assets_location']) )
-    struct = build_struct(settings, mailfolders)
+    assets = "{}/{}".format(settings['maildir_result'], settings['assets_location'])
+    if not manifest or not manifest.unchanged(os.path.relpath(assets, settings['maildir_result']), directory_fingerprint(settings['assets_location'])):
+        remove_dir(assets)
+        copyDir(settings['assets_location'], assets)
+    struct, messages = build_struct(settings, mailfolders)
     # print(struct)
-    for folder_id in mailfolders:
-        if not mailfolders[folder_id]["selected"]:
-            continue
-        to_local(settings, mailfolders, struct, folder_id)
+    set_threads(struct)
+    if manifest:
+        set_fingerprints(struct, manifest.base(settings, mailfolders, 'mail'), manifest.templates)
+    rendered = {}
+    pool = None
+    if int(settings.get('page_workers', 1)) > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=int(settings['page_workers']),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_render_worker,
+            initargs=(settings, mailfolders, struct),
+        )
+    try:
+        for folder_id in mailfolders:
+            if not mailfolders[folder_id]["selected"]:
+                continue
+            to_local(settings, mailfolders, struct, folder_id, messages[folder_id], rendered, pool, manifest)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if settings.get('db') and os.path.exists(settings['db']):
+        db = MessageIndex(settings['db'])
+        try:
+            db.clear_changes(account_id(settings))
+        finally:
+            db.close()
+    close_store(settings)
+    if manifest:
+        manifest.save()
+        print("%d unchanged pages kept, %d removed" % (manifest.reused, manifest.removed))
 
 
 def render_index(settings, mailfolders):
@@ -0,0 +1,206 @@
+"""
+Conversation threads of the thread structure built by templating.build_struct
+
+Messages are threaded once per build with jwz's algorithm
+(https://www.jwz.org/doc/threading.html) over their References and
+In-Reply-To headers, into a forest of containers kept in flat arrays. Every
+message record then gets its thread parent and children, the index of the
+root of its thread and its depth, for pages to look up in constant time.
+Subject grouping, the optional last step of the algorithm, is left out.
+"""
+import re
+
+
+message_id_re = re.compile(r"<[^<>\s]+>")
+
+
+def header_ids(value):
+    """
+    Returns the message ids found in a References or In-Reply-To header
+    """
+    return message_id_re.findall(value or "")
+
+
+class ThreadForest:
+    """
+    Containers of all the message ids of a struct, messages or only
+    referenced, as parallel arrays indexed by container number
+    """
+
+    def __init__(self, struct):
+        self.index = {}
+        self.ids = []
+        self.parent = []
+        self.children = []
+        self.message = []
+        self.root = []
+        self.depth = []
+
+        for mail_id, record in struct.items():
+            if "source" in record:
+                self.add(mail_id, record)
+        self.prune()
+        self.walk(struct)
+
+    def container(self, mail_id):
+        if not mail_id in self.index:
+            self.index[mail_id] = len(self.ids)
+            self.ids.append(mail_id)
+            self.parent.append(-1)
+            self.children.append([])
+            self.message.append(False)
+
+        return self.index[mail_id]
+
+    def is_ancestor(self, ancestor, node):
+        while node != -1:
+            if node == ancestor:
+                return True
+            node = self.parent[node]
+
+        return False
+
+    def link(self, parent, child):
+        if self.parent[child] != -1:
+            self.children[self.parent[child]].remove(child)
+        self.parent[child] = parent
+        if parent != -1:
+            self.children[parent].append(child)
+
+    def add(self, mail_id, record):
+        """
+        Threads a message: links its references one to the next, unless
+        already linked, and makes the last one its parent
+        """
+        node = self.container(mail_id)
+        self.message[node] = True
+
+        references = header_ids(record.get("references"))
+        for in_reply_to in header_ids(record.get("parent"))[:1]:
+            if not references or references[-1] != in_reply_to:
+                references.append(in_reply_to)
+
+        previous = -1
+        for reference in references:
+            current = self.container(reference)
+            if previous != -1 and self.parent[current] == -1 and not self.is_ancestor(current, previous):
+                self.link(previous, current)
+            previous = current
+
+        if previous == node or (previous != -1 and self.is_ancestor(node, previous)):
+            previous = -1
+        if self.parent[node] != previous:
+            self.link(previous, node)
+
+    def prune(self):
+        """
+        Drops containers of messages that were only referenced, when they have
+        no children, and promotes their children otherwise, but for roots
+        holding several children together
+        """
+        order = []
+        pending = [node for node in range(len(self.ids)) if self.parent[node] == -1]
+        while pending:
+            node = pending.pop()
+            order.append(node)
+            pending.extend(self.children[node])
+
+        for node in reversed(order):
+            if self.message[node]:
+                continue
+            parent = self.parent[node]
+            if parent == -1 and len(self.children[node]) > 1:
+                continue
+            for child in self.children[node]:
+                self.parent[child] = parent
+            if parent != -1:
+                siblings = self.children[parent]
+                position = siblings.index(node)
+                siblings[position:position + 1] = self.children[node]
+            self.children[node] = []
+            # Out of the forest
+            self.parent[node] = -2
+
+    def walk(self, struct):
+        """
+        Records the root and depth of every container, ordering children by
+        date
+        """
+        self.root = [-1] * len(self.ids)
+        self.depth = [0] * len(self.ids)
+        pending = [node for node in range(len(self.ids)) if self.parent[node] == -1]
+        for node in pending:
+            self.root[node] = node
+        while pending:
+            node = pending.pop()
+            self.children[node].sort(key=lambda child: struct.get(self.ids[child], {}).get("date") or ())
+            for child in self.children[node]:
+                self.root[child] = self.root[node]
+                self.depth[child] = self.depth[node] + 1
+                pending.append(child)
+
+    def apply(self, struct):
+        """
+        Replaces the In-Reply-To parents of struct by thread parents, and adds
+        records for the containers holding a thread together
+        """
+        for mail_id in [mail_id for mail_id, record in struct.items() if not "source" in record]:
+            del struct[mail_id]
+
+        for node, mail_id in enumerate(self.ids):
+            if self.root[node] == -1:
+                continue
+            if not mail_id in struct:
+                struct[mail_id] = {}
+            struct[mail_id].update({
+                "parent": self.ids[self.parent[node]] if self.parent[node] != -1 else "",
+                "children": [self.ids[child] for child in self.children[node]],
+                "node": node,
+                "thread": self.root[node],
+                "depth": self.depth[node],
+                "root": self.ids[self.root[node]],
+            })
+
+def set_threads(struct):
+    """
+    Threads the messages of struct, returns their ThreadForest
+    """
+    forest = ThreadForest(struct)
+    forest.apply(struct)
+
+    return forest
+
+def thread_tree(struct, root):
+    """
+    Returns (nodes, positions) of the thread starting at root: nested nodes
+    {id, link, date, subject, position, children} with children by date, and
+    the position of every message in the tree
+    """
+    positions = {}
+
+    def node(mail_id):
+        record = struct.get(mail_id, {})
+        positions[mail_id] = len(positions)
+        return {
+            "id": mail_id,
+            "link": record.get("link"),
+            "date": record.get("date"),
+            "subject": record.get("subject", "(mail not found)"),
+            "position": positions[mail_id],
+            "children": [],
+        }
+
+    top = node(root)
+    pending = [top]
+    while pending:
+        current = pending.pop()
+        for child_id in struct.get(current["id"], {}).get("children", []):
+            # A message replying to itself, or a loop of replies
+            if child_id in positions:
+                continue
+            child = node(child_id)
+            current["children"].append(child)
+            pending.append(child)
+        current["children"].sort(key=lambda child: child["date"] or ())
+
+    return [top], positions
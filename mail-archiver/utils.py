@@ -1,29 +1,69 @@
 import base64
 import chardet
+import codecs
+import functools
 import html
 import re
 import errno
+import hashlib
 import os
 import time
 from quopri import decodestring
 import shutil
 from slugify import slugify
 from email.header import decode_header
+from email.utils import parsedate
 
-import chardet
+# chardet only looks at this many bytes, starting at the first non ASCII one
+CHARDET_SAMPLE_SIZE = 32 * 1024
+
+declared_charset_re = re.compile(rb"charset\s*=\s*[\"']?([A-Za-z0-9_.:+-]+)", re.I)
+non_ascii_re = re.compile(rb"[\x80-\xff]")
+
+@functools.lru_cache(maxsize=256)
+def lookup_charset(label):
+    """
+    Returns the Python codec name of a charset label, None if unknown
+    """
+    try:
+        return codecs.lookup(label.strip().lower()).name
+    except LookupError:
+        return None
 
 def detect_encoding(byte_string):
-    # with open(file_path, 'rb') as file:
-
-    # detector = chardet.universaldetector.UniversalDetector()
-    # for line in byte_string:
-    #     detector.feed(line)
-    #     if detector.done:
-    #         break
-    #     detector.close()
-    detector = chardet.detect(byte_string)
-    
-    return detector['encoding']
+    """
+    Guesses the encoding of a byte string
+
+    Pure ASCII and valid UTF-8 are recognised by strict decoding, then charsets
+    declared in MIME headers are honoured, and only as a last resort chardet
+    runs over a bounded sample of the non ASCII part.
+    """
+    if byte_string.isascii():
+        return 'ascii'
+
+    try:
+        byte_string.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    for label in dict.fromkeys(declared_charset_re.findall(byte_string)):
+        encoding = lookup_charset(label.decode('ascii'))
+        if not encoding or encoding in ('ascii', 'utf-8'):
+            continue
+        try:
+            byte_string.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+
+    start = non_ascii_re.search(byte_string).start()
+    sample = byte_string[max(0, start - 1024):start + CHARDET_SAMPLE_SIZE]
+    detected = chardet.detect(sample)['encoding']
+    if not detected:
+        return None
+
+    return lookup_charset(detected) or detected
 
 def b64padanddecode(b):
     """
@@ -94,17 +134,17 @@ def normalize(unknown, encoding = None):
     if isinstance(unknown, str):
         unknown = unknown.encode()
 
-    estimate = chardet.detect(unknown)
+    estimate = detect_encoding(unknown)
 
-    if estimate["encoding"]:
-        if estimate["encoding"] == "utf-8":
+    if estimate:
+        if estimate in ("ascii", "utf-8"):
             return unknown.decode()
 
         try:
-            return unknown.decode(estimate["encoding"])
+            return unknown.decode(estimate)
         except Exception as e:
             # Maybe https://github.com/SSilence/php-imap-client/issues/112 ?
-            if estimate["encoding"].lower() == "Windows-1254".lower():
+            if lookup_charset(estimate) == lookup_charset("Windows-1254"):
                 return unknown.decode()
 
     if not isinstance(unknown, str):
@@ -195,3 +235,55 @@ def strftime(val, format="%Y-%m-%d %H:%m"):
         return "?"
 
     return str(time.strftime(format, val))
+
+def message_metadata(mail):
+    """
+    Returns the metadata record of a message: its headers decoded once, date
+    parsed and page file name
+    """
+    mail_id = mail.get('Message-Id')
+    mail_subject = normalize(mail.get('Subject'), 'header')
+    mail_from = normalize(mail.get('From'), 'header')
+    mail_to = normalize(mail.get('To'), 'header')
+
+    if not mail_subject:
+        mail_subject = "(No Subject)"
+
+    mail_date = parsedate(normalize(mail.get('Date'), 'header'))
+    if not mail_date:
+        mail_date = (2000, 1, 1, 12, 0, 00, 0, 1, -1)
+
+    if mail_id:
+        mail_id_hash = hashlib.md5(mail_id.encode()).hexdigest()
+    else:
+        temp = "%s %s %s %s" % (mail_subject, mail_date, mail_from, mail_to)
+        mail_id = hashlib.md5(temp.encode()).hexdigest()
+        mail_id_hash = mail_id
+
+    return message_file({
+        "id": mail_id,
+        "hash": mail_id_hash,
+        "date": mail_date,
+        "subject": mail_subject,
+        "from": mail_from,
+        "to": mail_to,
+        "parent": normalize(mail.get('In-Reply-To'), 'header'),
+        "references": normalize(mail.get('References'), 'header'),
+    })
+
+def message_file(metadata):
+    """
+    Sets the file name and link of the page of a message in its metadata
+    record, returns the record
+    """
+    fileName = "%s/%s.html" % (str(time.strftime("%Y/%m/%d", metadata["date"])), metadata["hash"])
+    metadata["file"] = fileName
+    metadata["link"] = "/%s" % fileName
+
+    return metadata
+
+def account_id(settings):
+    """
+    Returns the identifier of an account, as used in checkpoints
+    """
+    return "%s@%s" % (settings.get('username'), settings.get('domain'))